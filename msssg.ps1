@@ -3,7 +3,9 @@ $command = $args[0]
 function Run-Server {
     Push-Location www
     try {
-        php -S localhost:80 ../src/server.php
+        # www links into msssg/releases, so the router can't be found relative
+        # to it.
+        php -S localhost:80 (Join-Path $PSScriptRoot src/server.php)
     }
     finally {
         Pop-Location
@@ -18,6 +20,9 @@ Switch ($command) {
     "build" {
         py src/builder.py
     }
+    "profile" {
+        py src/builder.py --profile
+    }
     "run" {
         if (!(Test-Path www)) {
             py src/builder.py
@@ -37,6 +42,21 @@ Switch ($command) {
             Run-Server
         }
     }
+    "serve" {
+        py src/server.py
+    }
+    "research" {
+        py src/research.py $args[1..($args.Length - 1)]
+    }
+    "storage" {
+        py src/storage.py
+    }
+    "bench" {
+        py src/bench.py $args[1..($args.Length - 1)]
+    }
+    "load" {
+        py src/load.py $args[1..($args.Length - 1)]
+    }
     default {
         echo "Unknown command: $command"
     }
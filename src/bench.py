@@ -0,0 +1,344 @@
+import builder
+import json
+import numpy
+import os
+import PIL.Image
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+## The synthetic sites to benchmark, by name: how many pages there are, how
+## many pictures each page has, the source widths to pick the pictures' from,
+## and how long the chain of documents each page pulls in as assets is.
+SCENARIOS = {
+    "pages": {
+        "pages": 200,
+        "pictures": 0,
+        "widths": [],
+        "depth": 0,
+    },
+    "pictures": {
+        "pages": 8,
+        "pictures": 3,
+        "widths": [400, 1200, 2400],
+        "depth": 0,
+    },
+    "chains": {
+        "pages": 20,
+        "pictures": 0,
+        "widths": [],
+        "depth": 8,
+    },
+    "mixed": {
+        "pages": 40,
+        "pictures": 1,
+        "widths": [600, 1600],
+        "depth": 2,
+    },
+}
+
+## The stored results to compare against, by scenario and run.
+PATH_BASELINES = "bench/baselines.json"
+
+## How much worse than its baseline a measurement may get before it counts as
+## a regression.
+TOLERANCE_REGRESSION = 0.1
+
+## The build phases the builder's profile reports.
+PHASES = ["setup", "links", "dictionary", "history", "negotiations", "publish"]
+
+## Words to write the pages' text with.
+WORDS = (
+    "the quick brown fox jumps over lazy dog site static generator picture "
+    "graphic asset page link cache build render encode width quality source "
+    "somewhat masha manga coffee while little around sit expect extreme"
+).split()
+
+## Returns a document with the given title and body, in the form the builder
+## expects its sources in.
+def document(title, body):
+    return '''<!DOCTYPE html>
+<html
+    xmlns="http://www.w3.org/1999/xhtml"
+    xmlns:msssg="http://localhost/msssg"
+    lang="en"
+    xml:lang="en"
+>
+    <head>
+        <meta charset="UTF-8" />
+        <meta name="viewport" content="width=device-width, initial-scale=1" />
+        <title>''' + title + '''</title>
+        <link rel="stylesheet" href="style.css" msssg:asset="href" msssg:type="text/css;charset=UTF-8" />
+    </head>
+    <body>
+''' + body + '''
+    </body>
+</html>'''
+
+## Returns the given number of paragraphs of text.
+def paragraphs(generator, count):
+    return "\n".join(
+        "        <p>" + " ".join(generator.choices(WORDS, k=generator.randint(40, 120))) + "</p>"
+        for _ in range(count)
+    )
+
+## Returns a photo-like image of the given size: smooth shapes with some grain,
+## so that it compresses about as well as a real one.
+def picture(generator, width, height):
+    random_numpy = numpy.random.default_rng(generator.getrandbits(32))
+
+    coarse = random_numpy.integers(0, 256, (8, 8, 3), dtype=numpy.uint8)
+    image = PIL.Image.fromarray(coarse, "RGB").resize((width, height), PIL.Image.BICUBIC)
+
+    pixels = numpy.asarray(image).astype(numpy.int16)
+    pixels += random_numpy.integers(-12, 13, pixels.shape, dtype=numpy.int16)
+
+    return PIL.Image.fromarray(numpy.clip(pixels, 0, 255).astype(numpy.uint8), "RGB")
+
+## Generates the site of the given scenario into the given directory.
+def generate(path, scenario):
+    generator = random.Random(0)
+
+    os.makedirs(path + "/src/www")
+
+    shutil.copy(
+        os.path.dirname(os.path.abspath(__file__)) + "/" + os.path.basename(builder.PATH_ROUTER),
+        path + "/" + builder.PATH_ROUTER
+    )
+
+    file = open(path + "/src/www/style.css", "w")
+    file.write("body { margin: 0 auto; max-width: 40em; }\np { line-height: 1.5; }\n")
+    file.close()
+
+    links = {}
+
+    paths_pictures = []
+
+    for index in range(scenario["pages"]):
+        body = paragraphs(generator, generator.randint(3, 12))
+
+        for index_picture in range(scenario["pictures"]):
+            width = generator.choice(scenario["widths"])
+            height = round(width / generator.choice([4 / 3, 16 / 9, 1, 2 / 3]))
+
+            # Pages share some of their pictures, like real ones do.
+            if len(paths_pictures) > 0 and generator.random() < 0.25:
+                path_picture = generator.choice(paths_pictures)
+            else:
+                path_picture = "picture" + str(len(paths_pictures)) + ".png"
+                picture(generator, width, height).save(path + "/src/www/" + path_picture)
+                paths_pictures.append(path_picture)
+
+            # Every picture of a page needs a quality of its own.
+            quality = ["LOW", "MEDIUM", "HIGH", "LOSSLESS"][index_picture % 4]
+
+            body += '''
+        <picture msssg:type="GRAPHIC" msssg:quality="''' + quality + '''">
+            <img src="''' + path_picture + '''" srcset="''' + path_picture + '''" sizes="100vw" />
+        </picture>'''
+
+        # Each document of the chain pulls in the next as an asset.
+        for depth in reversed(range(scenario["depth"])):
+            path_chain = "chain" + str(index) + "-" + str(depth) + ".html"
+            body_chain = paragraphs(generator, 2)
+
+            if depth + 1 < scenario["depth"]:
+                body_chain += '''
+        <a href="chain''' + str(index) + "-" + str(depth + 1) + '''.html" msssg:asset="href" msssg:type="application/msssg+xml;charset=UTF-8">Next</a>'''
+
+            file = open(path + "/src/www/" + path_chain, "w")
+            file.write(document("Chain " + str(index) + "-" + str(depth), body_chain))
+            file.close()
+
+        if scenario["depth"] > 0:
+            body += '''
+        <a href="chain''' + str(index) + '''-0.html" msssg:asset="href" msssg:type="application/msssg+xml;charset=UTF-8">Chain</a>'''
+
+        file = open(path + "/src/www/page" + str(index) + ".html", "w")
+        file.write(document("Page " + str(index), body))
+        file.close()
+
+        links["/" if index == 0 else "/page" + str(index)] = {
+            "action": "RESOURCE",
+            "path": "src/www/page" + str(index) + ".html",
+            "type": "application/msssg+xml;charset=UTF-8",
+            "cache": "SHORT",
+        }
+
+    file = open(path + "/src/www/notfound.html", "w")
+    file.write(document("Not found", "        <p>Not found.</p>"))
+    file.close()
+
+    links["~notfound"] = {
+        "action": "RESOURCE",
+        "path": "src/www/notfound.html",
+        "type": "application/msssg+xml;charset=UTF-8",
+        "cache": "SHORT",
+    }
+
+    file = open(path + "/" + builder.PATH_LINKS, "w")
+    json.dump(links, file, indent=4)
+    file.close()
+
+## Returns the number of bytes of the published site in the given directory.
+def size_site(path):
+    size = os.path.getsize(path + "/" + builder.PATH_DATABASE)
+
+    for filename in os.listdir(path + "/" + builder.PATH_RESOURCES):
+        size += os.path.getsize(path + "/" + builder.PATH_RESOURCES + "/" + filename)
+
+    return size
+
+## Builds the site in the given directory, profiling it. Returns the
+## measurements of the build.
+def build(path):
+    output = tempfile.TemporaryFile()
+
+    time_start = time.perf_counter()
+
+    process = subprocess.Popen(
+        [sys.executable, os.path.dirname(os.path.abspath(__file__)) + "/builder.py", "--profile"],
+        cwd=path,
+        stdout=output,
+        stderr=subprocess.STDOUT
+    )
+
+    # Only Unix tells how much the build and its pool used; CPU time and memory
+    # go unmeasured elsewhere.
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    else:
+        usage = None
+        process.wait()
+
+    duration = time.perf_counter() - time_start
+
+    if process.returncode != 0:
+        output.seek(0)
+        sys.stdout.write(output.read().decode("UTF-8", "replace"))
+
+        raise RuntimeError("Build failed")
+
+    output.close()
+
+    measurement = {
+        "wall": duration,
+        "cpu": None,
+        "memory": None,
+        "bytes": size_site(path + "/" + builder.PATH_SITE),
+    }
+
+    # The usage includes the builder's pool, which is done by now. Peak memory
+    # is of the hungriest process rather than all of them together.
+    if usage is not None:
+        measurement["cpu"] = usage.ru_utime + usage.ru_stime
+        measurement["memory"] = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+    file = open(path + "/" + builder.PATH_SUMMARY_PROFILE, "r")
+    stages = json.load(file)["stages"]
+    file.close()
+
+    for phase in PHASES:
+        stage = stages.get("stage " + phase)
+        measurement[phase] = stage["total"] if stage is not None else 0
+
+    return measurement
+
+## Runs the given scenario: a build from scratch and then a rebuild without any
+## changes. Returns the measurements of both.
+def run(scenario):
+    directory = tempfile.TemporaryDirectory()
+
+    try:
+        generate(directory.name, scenario)
+
+        return {
+            "cold": build(directory.name),
+            "warm": build(directory.name),
+        }
+    finally:
+        directory.cleanup()
+
+## Formats the given measurement of the given metric.
+def format_metric(metric, value):
+    if value is None:
+        return "-"
+
+    match metric:
+        case "bytes" | "memory":
+            return format(value / 1000000, ".2f") + " MB"
+        case _:
+            return format(value, ".3f") + " s"
+
+def main():
+    arguments = sys.argv[1:]
+
+    saving = "--save" in arguments
+    names = [argument for argument in arguments if argument != "--save"]
+
+    if len(names) == 0:
+        names = list(SCENARIOS.keys())
+
+    for name in names:
+        if name not in SCENARIOS:
+            print("Unknown scenario: " + name)
+
+            sys.exit(1)
+
+    if os.path.exists(PATH_BASELINES):
+        file = open(PATH_BASELINES, "r")
+        baselines = json.load(file)
+        file.close()
+    else:
+        baselines = {}
+
+    regressed = False
+
+    for name in names:
+        print("\x1B[102;30m " + name + " \x1B[0m")
+
+        results = run(SCENARIOS[name])
+
+        for kind, measurement in results.items():
+            print(kind)
+
+            baseline = baselines.get(name, {}).get(kind, {})
+
+            for metric, value in measurement.items():
+                line = "    " + metric.ljust(14) + format_metric(metric, value).rjust(12)
+
+                value_baseline = baseline.get(metric)
+
+                if value is not None and value_baseline:
+                    change = value / value_baseline - 1
+
+                    line += "  " + format(change * 100, "+.1f") + "%"
+
+                    # Phases are too short and noisy to judge on their own.
+                    if metric not in PHASES and change > TOLERANCE_REGRESSION:
+                        line = "\x1B[91m" + line + " regression\x1B[0m"
+                        regressed = True
+
+                print(line)
+
+        if saving:
+            baselines[name] = results
+
+    if saving:
+        os.makedirs(os.path.dirname(PATH_BASELINES), exist_ok=True)
+
+        file = open(PATH_BASELINES, "w")
+        json.dump(baselines, file, indent=4, sort_keys=True)
+        file.close()
+
+        print("Saved baselines to " + PATH_BASELINES)
+
+    if regressed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
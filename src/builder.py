@@ -1,34 +1,52 @@
-import astropy.time
 import base64
 import bisect
 import brotli
+import contextlib
 import gzip
 import hashlib
+import heapq
 import io
 import itertools
 import json
 import lxml.cssselect as cssselect
 import lxml.html as html
 import lxml.etree as xml
-import math
 import minify_html
 import multiprocessing
 import multiprocessing.managers
+import multiprocessing.resource_tracker
 import multiprocessing.shared_memory
+import numpy
 import os
 import pathlib
 import PIL.Image
+import re
 import signal
 import shutil
 import sqlite3
-import subprocess
+import struct
 import sys
-import tempfile
 import threading
 import time
 import zlib
 import traceback
 
+# Optional encoders; their encodings are left out if they're not installed.
+try:
+    import zopfli.gzip
+    import zopfli.zlib
+except ImportError:
+    zopfli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+# Needed for AVIF and JPEG XL graphics only.
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
 ## Whether the output website uses a dynamic runtime.
 DYNAMIC_OUTPUT = True
 
@@ -44,17 +62,141 @@ PREFIX_URI_ASSET = "a/"
 ## The length of asset IDs.
 LENGTH_ID_ASSET = 16
 
-## The available encoding methods.
+## The directory of the build cache.
+PATH_CACHE = "msssg/cache"
+
+## The version of the build cache. Bump this whenever a change to the builder
+## changes what a cached stage outputs for the same inputs and settings.
+VERSION_CACHE = 3
+
+## The versions of the libraries that render graphics. Part of the cache keys of
+## renders, since upgrading an encoder changes its output.
+VERSIONS_ENCODER_GRAPHIC = {
+    "pillow": PIL.__version__,
+    "imagecodecs": None if imagecodecs is None else imagecodecs.__version__,
+}
+
+## The namespaces used in msssg documents.
+NAMESPACES_DOCUMENT = {
+    "xhtml": "http://www.w3.org/1999/xhtml",
+    "msssg": "http://localhost/msssg",
+}
+
+## The available encoding methods, each with its candidate encoders by name.
+## Data is encoded with every candidate and only the smallest result is kept.
 ENCODERS_ENCODING = {
-    "gzip": lambda data: gzip.compress(data),
-    "deflate": lambda data: zlib.compress(data, level=9),
-    "br": lambda data: brotli.compress(data),
+    "gzip": {
+        # No timestamp, so that the same data always encodes the same.
+        "gzip": lambda data: gzip.compress(data, compresslevel=9, mtime=0),
+        "zlib-filtered": lambda data: compress_zlib(data, 31, zlib.Z_FILTERED),
+    },
+    "deflate": {
+        "zlib": lambda data: compress_zlib(data, 15, zlib.Z_DEFAULT_STRATEGY),
+        "zlib-filtered": lambda data: compress_zlib(data, 15, zlib.Z_FILTERED),
+    },
+    "br": {
+        "brotli": lambda data: brotli.compress(data, quality=11, lgwin=24),
+        "brotli-text": lambda data: brotli.compress(
+            data,
+            mode=brotli.MODE_TEXT,
+            quality=11,
+            lgwin=24
+        ),
+    },
+}
+
+if zopfli is not None:
+    ENCODERS_ENCODING["gzip"]["zopfli"] = lambda data: zopfli.gzip.compress(data)
+    ENCODERS_ENCODING["deflate"]["zopfli"] = lambda data: zopfli.zlib.compress(data)
+
+if zstandard is not None:
+    ENCODERS_ENCODING["zstd"] = {
+        # Browsers won't decode with windows over 8 MiB.
+        "zstd": lambda data: zstandard.ZstdCompressor(
+            compression_params=zstandard.ZstdCompressionParameters.from_level(
+                22,
+                window_log=23
+            )
+        ).compress(data),
+    }
+
+## The size of the dictionary shared by all text resources, which they're also
+## encoded with as `dcz` if zstandard is available.
+SIZE_DICTIONARY = 65536
+
+## The types of the resources that are encoded with the shared dictionary, and
+## that it is trained on.
+TYPES_DICTIONARY = (
+    "text/",
+    "application/xhtml+xml",
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+)
+
+## How much of the text resources' bytes may have changed since the shared
+## dictionary was trained on them before it is trained again, as a share of the
+## bytes it was trained on. Retraining encodes every text resource again.
+SHARE_RETRAIN_DICTIONARY = 0.5
+
+## The cache control headers of the URI caches.
+HEADERS_CACHE = {
+    "NONE": None,
+    "SHORT": "public, max-age=100", # 1.7 minutes.
+    "MEDIUM": "public, max-age=10000", # 2.8 hours.
+    "LONG": "public, max-age=1000000", # 11.6 days.
+    "INDEFINITE": "public, max-age=31536000, immutable",
 }
 
 ## The threshold at which point the builder will prefer to store encoded
 ## resources as files in the filesystem instead of as blobs in the database.
 THRESHOLD_ENCODING = 100000
 
+## The results of the storage benchmark (`msssg storage`). If the benchmark has
+## been run, the threshold it measured takes the place of the one above.
+PATH_STORAGE = "msssg/storage.json"
+
+## Whether the builder streams the database to disk as it goes, instead of
+## building it in memory and only writing it out at the very end. Streaming
+## keeps memory use bounded no matter how big the site gets.
+STREAMING_DATABASE = True
+
+## The number of statements to batch into each transaction on the database.
+SIZE_TRANSACTION_DATABASE = 1000
+
+## The directory builds are staged in before they are published as `www`.
+PATH_RELEASES = "msssg/releases"
+
+## The links of the site.
+PATH_LINKS = "src/links.json"
+
+## The router of the site, published along with every build.
+PATH_ROUTER = "src/server.php"
+
+## Where the live site is published.
+PATH_SITE = "www"
+
+## The database of a site, relative to the site.
+PATH_DATABASE = "database.db"
+
+## The directory of the resource files of a site, relative to the site.
+PATH_RESOURCES = "resources"
+
+## The number of processes to run p-tasks on.
+COUNT_PROCESSES = os.cpu_count()
+
+## The number of threads to run n-tasks on.
+COUNT_THREADS = 2 * os.cpu_count()
+
+## The length from which on documents are parsed and serialized in the pool
+## instead of on the scheduler's threads.
+LENGTH_PARALLEL_DOCUMENT = 100000
+
+## The number of threads each p-task may encode an image with. The pool already
+## runs a process on every core, so more threads would only compete with those.
+## Worth raising along with lowering `COUNT_PROCESSES`.
+COUNT_THREADS_ENCODER = 1
+
 ## The step size of the widths of the rendered graphic images.
 STEP_WIDTH_GRAPHIC = 100
 
@@ -106,12 +248,91 @@ QUALITIES_GRAPHIC = {
     },
 }
 
-## The preferred width of the fallback graphic image.
+## Whether to search for the lowest encoder quality setting that still renders
+## each graphic image at its quality's SSIM target, instead of taking the
+## setting from the quality settings above.
+SEARCH_QUALITY_GRAPHIC = False
+
+## The SSIM targets of the qualities of lossy graphic renders.
+TARGETS_SSIM_GRAPHIC = {
+    "LOW": 0.90,
+    "MEDIUM": 0.95,
+    "HIGH": 0.98,
+}
+
+## The ranges of encoder quality settings to search through for each type.
+RANGES_QUALITY_GRAPHIC = {
+    "image/jpeg": (0, 100),
+    "image/webp": (0, 100),
+}
+
+## How many times wider an already resized image must be than a graphic image
+## being rendered for it to be resized from that image instead of the source.
+## Resizing down a pyramid like this is much cheaper than resizing everything
+## from the full resolution source, and costs next to no quality so long as the
+## gap stays at 2 or above. Set to `None` to always resize from the source.
+GAP_PYRAMID_GRAPHIC = None
+
+## Whether to losslessly squeeze the rendered images further. PNGs are
+## recompressed with every filter and in smaller pixel formats wherever those
+## lose nothing, and JPEGs are tried as progressive as well.
+OPTIMIZING_GRAPHIC = True
+
+## Whether to minify text resources before they are encoded. Documents are
+## turned from XHTML into HTML on the way, which is what lets them shed their
+## closing tags and quotes; the stylesheets and SVG within them are minified as
+## well.
+MINIFYING_OUTPUT = True
+
+## The types of the resources that are minified.
+TYPES_MINIFY = (
+    "application/xhtml+xml",
+    "text/css",
+)
+
+## Where a build writes how many bytes minifying saved on each asset it built.
+PATH_REPORT_MINIFY = "msssg/minify.json"
+
+## Whether to inline the stylesheets a document links into the document, in
+## place of the link, sparing visitors the round trip to fetch them before the
+## page renders at all. Only the rules that match elements of the document are
+## inlined. Leave this off for documents whose scripts add elements styled by
+## rules nothing else matches.
+INLINING_STYLESHEETS = False
+
+## The longest the inlined rules of a stylesheet may be, in bytes. Stylesheets
+## with more rules than that are linked as usual. About what the first round
+## trip of a connection can carry.
+LENGTH_INLINE_STYLESHEET = 14000
+
+## The pseudo-classes that depend on what the visitor does rather than on the
+## document, and pseudo-elements. Both are left out of selectors when matching
+## them against a document, so that rules using them are kept if the rest of
+## their selector matches.
+PATTERN_DYNAMIC_SELECTOR = re.compile(
+    r"::[\w-]+(\([^)]*\))?"
+    r"|:(-[\w-]+"
+    r"|hover|active|focus|focus-visible|focus-within|visited|link|any-link|target"
+    r"|checked|indeterminate|default|valid|invalid|user-valid|user-invalid"
+    r"|in-range|out-of-range|required|optional|placeholder-shown|autofill"
+    r"|before|after|first-line|first-letter)(?![\w-])"
+)
+
+## The preferred width of the fallback graphic image. Graphic images narrower
+## than this fall back to their widest rendered image instead.
 WIDTH_FALLBACK_GRAPHIC = 1200
 
 ## The maximum width of a generated graphic image.
 WIDTH_MAXIMUM_GRAPHIC = 4000
 
+## Where a build run with `--profile` writes its trace, which can be opened in
+## Perfetto or Chrome's `about:tracing`, and the summary of it.
+PATH_TRACE_PROFILE = "msssg/profile-trace.json"
+PATH_SUMMARY_PROFILE = "msssg/profile.json"
+
+## The number of slowest assets to list in the profile summary.
+COUNT_SLOWEST_PROFILE = 20
+
 # Sanity checks on the constants.
 assert WIDTH_FALLBACK_GRAPHIC % STEP_WIDTH_GRAPHIC == 0
 assert WIDTH_MAXIMUM_GRAPHIC % STEP_WIDTH_GRAPHIC == 0
@@ -184,721 +405,2499 @@ def animate():
             frame = 0
         time.sleep(1 / FPS)
 
+## The spans recorded by this process while profiling, each a tuple of a name,
+## a category, details, the process and thread that ran it, and its start and
+## end time. `None` if not profiling.
+spans = None
+
+## Records a span of the given name, details and category that started at the
+## given time and ends now, if profiling.
+def record_span(name, time_start, details=None, category="stage"):
+    if spans is None:
+        return
+
+    spans.append((
+        name,
+        category,
+        details if details is not None else {},
+        os.getpid(),
+        threading.get_native_id(),
+        time_start,
+        time.perf_counter()
+    ))
+
+## Records a span of the given name, details and category over the code it
+## wraps, if profiling.
+@contextlib.contextmanager
+def span(name, details=None, category="stage"):
+    time_start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record_span(name, time_start, details, category)
+
 ## Initializes a worker process.
-def initializer():
+def initializer(profiling=False):
+    global spans
+
     # Let the main process deal with interrupts.
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-## Reads the given file into memory and returns it.
-def data_file(path):
-    data = b""
-    file = open(path, "rb")
-    while buffer := file.read():
-        data += buffer
-    file.close()
+    if profiling:
+        spans = []
+
+## Runs the given function of a p-task with the given arguments while
+## profiling, recording a span of it along with how long it was queued since
+## the given time. Returns its result along with the spans recorded meanwhile.
+def run_profiled(function, arguments, name, details, time_queued):
+    spans.clear()
+
+    with span(
+        name,
+        dict(details, wait=time.perf_counter() - time_queued),
+        "ptask"
+    ):
+        result = function(*arguments)
+
+    return result, list(spans)
+
+## An asynchronous task run by a scheduler. Tasks come in two flavors:
+## n-tasks, which are non-parallel and run on one of the scheduler's threads,
+## and p-tasks, which are parallel and run on one of its pool's processes.
+class Task:
+    ## Creates a new task. Use `Scheduler.ntask` and `Scheduler.ptask` instead.
+    def __init__(self, scheduler, function, arguments, priority, parallel, name, details):
+        self.scheduler = scheduler
+        self.function = function
+        self.arguments = arguments
+        self.priority = priority
+        self.parallel = parallel
+
+        # What to call the task's span when profiling.
+        self.name = name if name is not None else function.__name__
+        self.details = details if details is not None else {}
+        self.time_queued = None
+
+        # One of "BLOCKED" (on its dependencies), "QUEUED", "RUNNING" or
+        # "DONE".
+        self.state = "BLOCKED"
+        self.dependencies = []
+        self.dependents = []
+
+        self.success = None
+        self.result = None
+
+    ## Awaits the result of this task.
+    def wait(self):
+        return self.scheduler.wait(self)
+
+## A bounded task scheduler. N-tasks run on a fixed set of threads and p-tasks
+## on a fixed set of processes, highest priority first and only once all of
+## their dependencies are done.
+##
+## Tasks may wait on other tasks. A waiting thread runs the awaited task itself
+## if nobody has picked it up yet, so that the threads never all end up stuck
+## waiting on work that nobody is left to do. It never helps out with anything
+## else in the meantime: with tasks shared between links, that could be waiting
+## on a task further down its own stack.
+class Scheduler:
+    ## Creates a new scheduler running p-tasks on the given pool.
+    def __init__(self, pool, count_processes, count_threads):
+        self.pool = pool
+        self.count_processes = count_processes
+
+        self.condition = threading.Condition()
+        self.queue_ntasks = []
+        self.queue_ptasks = []
+        self.sequence = itertools.count()
+        self.running_ptasks = 0
+        self.closed = False
+
+        for _ in range(count_threads):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    ## Creates a new n-task and schedules it. The given name and details go
+    ## into its span when profiling.
+    def ntask(self, function, arguments, priority=0, dependencies=(), name=None, details=None):
+        return self.schedule(
+            Task(self, function, arguments, priority, False, name, details),
+            dependencies
+        )
 
-    return data
+    ## Creates a new p-task and schedules it. The given name and details go
+    ## into its span when profiling.
+    def ptask(self, function, arguments, priority=0, dependencies=(), name=None, details=None):
+        return self.schedule(
+            Task(self, function, arguments, priority, True, name, details),
+            dependencies
+        )
 
-## Hashes the given data.
-def hash(data):
-    hasher = hashlib.new(ALGORITHM_HASH)
-    hasher.update(SALT_HASH)
-    hasher.update(data)
+    ## Schedules the given task once the given tasks are done.
+    def schedule(self, task, dependencies):
+        with self.condition:
+            for dependency in dependencies:
+                if dependency.state != "DONE":
+                    task.dependencies.append(dependency)
+                    dependency.dependents.append(task)
 
-    return hasher.digest()
+            if len(task.dependencies) == 0:
+                self.enqueue(task)
 
-## Encodes the given data using the given encoding method.
-def encode(data, encoding):
-    return ENCODERS_ENCODING[encoding](data)
+        return task
 
-## Rerenders the given image with the given specifications.
-def render_image(data, type, width, quality):
-    assert isinstance(width, int) or width.is_integer()
+    ## Queues the given task. The caller must hold the condition.
+    def enqueue(self, task):
+        task.state = "QUEUED"
+        task.time_queued = time.perf_counter()
 
-    match quality:
-        case "VERY LOW" | "LOW" | "MEDIUM" | "HIGH" | "VERY HIGH" | "LOSSLESS":
-            pass
-        case _:
-            raise RuntimeError("Unknown quality: " + quality)
-    if not quality in QUALITIES_GRAPHIC[type]:
-        raise RuntimeError("Unsupported quality for " + type + ": " + quality)
+        heapq.heappush(
+            self.queue_ptasks if task.parallel else self.queue_ntasks,
+            (-task.priority, next(self.sequence), task)
+        )
 
-    definition_quality = QUALITIES_GRAPHIC[type][quality]
+        if task.parallel:
+            self.dispatch()
 
-    if isinstance(definition_quality, dict):
-        widths = sorted(definition_quality.keys())
-        
-        index_width = bisect.bisect_right(widths, width)
+        self.condition.notify_all()
 
-        # Calculate interpolant.
-        if index_width == 0:
-            value_quality = definition_quality[widths[0]]
-        elif index_width == len(widths):
-            value_quality = definition_quality[widths[len(widths) - 1]]
-        else:
-            value_quality = round(
-                definition_quality[widths[index_width - 1]] \
-                + (definition_quality[widths[index_width]] - definition_quality[widths[index_width - 1]]) \
-                    * (width - widths[index_width - 1]) \
-                    / (widths[index_width] - widths[index_width - 1])
-            )
-    else:
-        value_quality = definition_quality
+    ## Hands queued p-tasks to the pool for as long as it has idle processes.
+    ## The caller must hold the condition.
+    def dispatch(self):
+        # Only ever keep the pool itself busy instead of filling up its queue,
+        # so that priorities are still honored for everything else.
+        while len(self.queue_ptasks) > 0 \
+        and self.running_ptasks < self.count_processes:
+            _, _, task = heapq.heappop(self.queue_ptasks)
 
-    # TODO is `PIL.Image` pickleable?
-    image = PIL.Image.open(io.BytesIO(data))
+            task.state = "RUNNING"
+            self.running_ptasks += 1
 
-    if width > image.width:
-        # TODO maybe this should only be a warning instead?
-        raise RuntimeError("Rendered image resolution limited by source resolution")
+            if spans is None:
+                function = task.function
+                arguments = task.arguments
+            else:
+                function = run_profiled
+                arguments = (
+                    task.function,
+                    task.arguments,
+                    task.name,
+                    task.details,
+                    task.time_queued
+                )
 
-    # TODO strip metadata
+            self.pool.apply_async(
+                function,
+                args=arguments,
+                callback=lambda result, task=task:
+                    self.finish(task, True, result),
+                error_callback=lambda exception, task=task:
+                    self.finish(task, False, exception)
+            )
 
-    if width != image.width:
-        aspect = image.width / image.height
+    ## Pops the next queued n-task, or returns `None` if there is none. The
+    ## caller must hold the condition.
+    def pop(self):
+        while len(self.queue_ntasks) > 0:
+            _, _, task = heapq.heappop(self.queue_ntasks)
+
+            # Tasks run by whoever waited on them are left in the queue.
+            if task.state == "QUEUED":
+                task.state = "RUNNING"
+
+                return task
+
+        return None
+
+    ## Runs the given n-task on the current thread.
+    def run(self, task):
+        try:
+            with span(
+                task.name,
+                dict(task.details, wait=time.perf_counter() - task.time_queued),
+                "ntask"
+            ):
+                result = task.function(*task.arguments)
+            success = True
+        except Exception as exception:
+            result = exception
+            success = False
+
+        self.finish(task, success, result)
+
+    ## Finishes the given task with the given result.
+    def finish(self, task, success, result):
+        if task.parallel and success and spans is not None:
+            result, spans_task = result
+            spans.extend(spans_task)
+
+        with self.condition:
+            task.success = success
+            task.result = result
+            task.state = "DONE"
+
+            if task.parallel:
+                self.running_ptasks -= 1
+                self.dispatch()
+
+            for dependent in task.dependents:
+                dependent.dependencies.remove(task)
+
+                if len(dependent.dependencies) == 0:
+                    self.enqueue(dependent)
+
+            task.dependents = []
+
+            self.condition.notify_all()
+
+    ## Runs queued n-tasks until the scheduler is closed.
+    def work(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        return
 
-        height = round(width / aspect)
+                    task = self.pop()
+                    if task is not None:
+                        break
 
-        image = image.resize((width, height), PIL.Image.LANCZOS)
+                    self.condition.wait()
 
-    output = io.BytesIO()
+            self.run(task)
 
-    match type:
-        case "image/png":
-            image.save(output, format="PNG", optimize=True)
-        case "image/jpeg":
-            image.save(output, format="JPEG", quality=value_quality, optimize=True)
-        # case "image/jpeg2000":
-        #     image.save(output, format="JPEG2000", irreversible=False)
-        case "image/webp":
-            if quality == "LOSSLESS":
-                image.save(output, format="WebP", lossless=True, quality=100, method=6)
-            else:
-                image.save(output, format="WebP", quality=value_quality, method=6)
-        case "image/avif":
-            directory = tempfile.TemporaryDirectory()
+    ## Awaits the result of the given task.
+    def wait(self, task):
+        # Ctrl-C only ever gets handled on the main thread, and a blocked
+        # `Condition.wait` won't reliably wake up for it (never on Windows, and
+        # only sometimes elsewhere), so the main thread has to wake up every so
+        # often to let it through.
+        if threading.current_thread() is threading.main_thread():
+            timeout = 1
+        else:
+            timeout = None
 
-            image.save(directory.name + "/input.png", format="PNG")
-            image.close()
+        self.condition.acquire()
 
-            subprocess.run(
-                "dependencies/avifenc -l -s 0 -j " + str(os.cpu_count()) + " " + directory.name + "/input.png " + directory.name + "/output.avif",
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-            )
+        try:
+            while task.state != "DONE":
+                if task.state == "BLOCKED":
+                    dependency = task.dependencies[0]
 
-            output.write(data_file(directory.name + "/output.avif"))
+                    self.condition.release()
+                    try:
+                        self.wait(dependency)
+                    except Exception:
+                        pass
+                    finally:
+                        self.condition.acquire()
 
-            directory.cleanup()
+                    continue
 
-        case "image/jxl":
-            directory = tempfile.TemporaryDirectory()
+                # Nobody has picked the task up yet; run it right here.
+                if task.state == "QUEUED" and not task.parallel:
+                    task.state = "RUNNING"
 
-            image.save(directory.name + "/input.png", format="PNG")
-            image.close()
+                    self.condition.release()
+                    try:
+                        self.run(task)
+                    finally:
+                        self.condition.acquire()
 
-            subprocess.run(
-                "dependencies/cjxl " + directory.name + "/input.png " + directory.name + "/output.jxl -q 100 -e 9",
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-            )
+                    continue
 
-            output.write(data_file(directory.name + "/output.jxl"))
+                self.condition.wait(timeout)
 
-            directory.cleanup()
+        finally:
+            self.condition.release()
 
-        case _:
-            raise RuntimeError("Unknown type " + type)
+        if task.success:
+            return task.result
+        else:
+            raise task.result
 
-    data = output.getvalue()
+    ## Stops the scheduler's threads once they are done with what they are
+    ## running.
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
 
-    output.close()
-    image.close()
+## Reads the given file into memory and returns it.
+def data_file(path):
+    data = b""
+    file = open(path, "rb")
+    while buffer := file.read():
+        data += buffer
+    file.close()
 
     return data
 
-def main():
-    try:
-        time_start = time.monotonic()
+## Hashes the given data.
+def hash(data):
+    hasher = hashlib.new(ALGORITHM_HASH)
+    hasher.update(SALT_HASH)
+    hasher.update(data)
 
-        animator = multiprocessing.Process(target=animate)
-        animator.start()
+    return hasher.digest()
 
-        revision = astropy.time.Time.now()
-        revision.format = "unix_tai"
-        revision = float(str(revision))
+## Returns the asset ID of the file at the given path.
+def id_path(path):
+    return os.path.relpath(path).replace("\\", "/")
 
-        pool = multiprocessing.Pool(initializer=initializer)
+## Returns a stamp of the given input file, given the hash of its data, that
+## later builds can use to tell whether the file has changed.
+def stamp_file(path, hash_data):
+    stat = os.stat(path)
 
-        lock = threading.Lock()
+    return [stat.st_mtime_ns, stat.st_size, hash_data.hex()]
 
-        ## A parallel asynchronous task backed by a process.
-        class PTask:
-            ## Creates a new p-task and starts it.
-            def __init__(self, function, arguments):
-                self.event = threading.Event()
+## Returns whether the given input file still matches the given stamp.
+def matches_stamp(path, stamp):
+    if not os.path.exists(path):
+        return False
 
-                def callback(_):
-                    self.event.set()
+    stat = os.stat(path)
 
-                self.result = pool.apply_async(
-                    function,
-                    args=arguments,
-                    callback=callback,
-                    error_callback=callback
-                )
+    # Only look at the contents if the file has been touched at all.
+    if [stat.st_mtime_ns, stat.st_size] == stamp[:2]:
+        return True
 
-            ## Awaits the result of this p-task.
-            def wait(self):
-                FREQUENCY = 5
+    return hash(data_file(path)).hex() == stamp[2]
 
-                # For some stupid fucking reason, `AsyncResult.get` and
-                # `AsyncResult.wait` never raise `KeyboardInterrupt`, and so the
-                # workaround is to use events instead. Sometimes, I feel like
-                # using Python is less "using" it and more "fighting" it...
-                while not self.event.wait(1 / FREQUENCY):
-                    pass
+## Computes the cache key of the output of the given stage for the given input
+## data and the settings that affect it.
+def key_cache(stage, data, settings=None):
+    hasher = hashlib.new(ALGORITHM_HASH)
+    hasher.update(SALT_HASH)
+    hasher.update(json.dumps(
+        [VERSION_CACHE, stage, settings],
+        sort_keys=True
+    ).encode("UTF-8"))
+    # JSON never contains a raw null character, so this can't be ambiguous.
+    hasher.update(b"\0")
+    hasher.update(data)
 
-                return self.result.get()
+    return hasher.hexdigest()
 
-        ## A non-parallel asynchronous task backed by a thread.
-        class NTask:
-            ## Creates a new n-task and starts it.
-            def __init__(self, function, arguments):
-                # TODO maybe using a threadpool might be more efficient.
+## Places the file at the given path at the given new path, preferably as a hard
+## link so that no data has to be copied.
+def link_file(path_source, path):
+    try:
+        os.link(path_source, path)
+    except OSError:
+        shutil.copyfile(path_source, path)
 
-                def runner(ntask, function, arguments):
-                    try:
-                        result = function(*arguments)
-
-                        ntask.success = True
-                        self.result = result
-                    except Exception as exception:
-                        ntask.success = False
-                        self.result = exception
-
-                self.thread = threading.Thread(
-                    target=runner,
-                    args=(self, function, arguments),
-                    daemon=True
-                )
-                self.thread.start()
+## Removes the symbolic link at the given path.
+def remove_link(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # Links to directories are directories themselves on Windows.
+        if os.name != "nt":
+            raise
 
-            ## Awaits the result of this n-task.
-            def wait(self):
-                FREQUENCY = 5
+        os.rmdir(path)
 
-                while True:
-                    # What an incredibly annoying language Python is. I honestly
-                    # wonder if I've sunken-cost-fallacy'd myself into throwing
-                    # more time into getting around Python's foibles instead of,
-                    # say, rewriting everything in Ruby or something.
-                    self.thread.join(1 / FREQUENCY)
-                    if not self.thread.is_alive():
-                        break
+## Publishes the release at the given path as `www`. Where symbolic links are
+## available, `www` links to the release and is flipped over atomically.
+## Otherwise the release is moved into place. Returns the path of the release
+## that was replaced, if any.
+def publish_release(path_release):
+    path_replaced = os.path.realpath(PATH_SITE) if os.path.exists(PATH_SITE) else None
 
-                if self.success:
-                    return self.result
-                else:
-                    raise self.result
+    # A real directory; either from before releases or from a system without
+    # symbolic links. Move it aside with the other releases first.
+    if os.path.isdir(PATH_SITE) and not os.path.islink(PATH_SITE):
+        path_replaced = path_release + "-previous"
 
-        if os.path.exists("www"):
-            shutil.rmtree("www")
-        
-        os.mkdir("www")
-        os.mkdir("www/resources")
+        os.rename(PATH_SITE, path_replaced)
 
-        database = sqlite3.connect(
-            ":memory:",
-            timeout=30,
-            isolation_level=None,
-            check_same_thread=False
-        )
-        database.executescript('''
-            PRAGMA foreign_keys = 1;
-            PRAGMA analysis_limit = 0;
+    try:
+        if os.path.lexists(PATH_SITE + "-publishing"):
+            remove_link(PATH_SITE + "-publishing")
+
+        os.symlink(path_release, PATH_SITE + "-publishing", target_is_directory=True)
+        os.replace(PATH_SITE + "-publishing", PATH_SITE)
+    except OSError:
+        if os.path.lexists(PATH_SITE):
+            remove_link(PATH_SITE)
+
+        os.rename(path_release, PATH_SITE)
+
+    return path_replaced
+
+## Returns the threshold at which point encodings are stored in the filesystem.
+def threshold_encoding():
+    if os.path.exists(PATH_STORAGE):
+        return json.load(open(PATH_STORAGE, "r"))["threshold"]
+
+    return THRESHOLD_ENCODING
+
+## Returns a fingerprint of the builder settings that affect the build output
+## as a whole.
+def fingerprint_settings():
+    return key_cache("settings", b"", {
+        "dynamic": DYNAMIC_OUTPUT,
+        "prefix": PREFIX_URI_ASSET,
+        "length": LENGTH_ID_ASSET,
+        "encodings": {
+            encoding: list(encoders.keys())
+            for encoding, encoders in ENCODERS_ENCODING.items()
+        },
+        "threshold": threshold_encoding(),
+        "dictionary": [SIZE_DICTIONARY, TYPES_DICTIONARY, zstandard is not None],
+        "step": STEP_WIDTH_GRAPHIC,
+        "qualities": QUALITIES_GRAPHIC,
+        "optimizing": OPTIMIZING_GRAPHIC,
+        "minifying": MINIFYING_OUTPUT,
+        "inlining": [INLINING_STYLESHEETS, LENGTH_INLINE_STYLESHEET],
+        "fallback": WIDTH_FALLBACK_GRAPHIC,
+        "maximum": WIDTH_MAXIMUM_GRAPHIC,
+    })
+
+## Returns the path of the cache entry with the given key.
+def path_cache(key):
+    return PATH_CACHE + "/" + key[:2] + "/" + key
+
+## Reads the cache entry with the given key. Returns `None` if there is none.
+def read_cache(key):
+    path = path_cache(key)
+
+    if not os.path.exists(path):
+        return None
+
+    return data_file(path)
+
+## Writes the cache entry with the given key.
+def write_cache(key, data):
+    path = path_cache(key)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write to a temporary file first so that an interrupted build never
+    # leaves a truncated entry behind.
+    path_temporary = path + "." + str(os.getpid()) + "-" + str(threading.get_ident())
+
+    file = open(path_temporary, "wb")
+    file.write(data)
+    file.close()
 
-            CREATE TABLE uris (
-                uri TEXT,
-                action TEXT NOT NULL,
-                cache TEXT NOT NULL,
-                PRIMARY KEY (uri),
-                CHECK (action IN ("RESOURCE", "REDIRECT", "DELETION")),
-                CHECK (cache IN ("NONE", "SHORT", "MEDIUM", "LONG", "INDEFINITE"))
-            );
-            CREATE TABLE resources (
-                uri TEXT,
-                type TEXT NOT NULL,
-                etag TEXT NOT NULL,
-                PRIMARY KEY (uri),
-                FOREIGN KEY (uri) REFERENCES uris(uri)
-            );
-            CREATE TABLE encodings (
-                uri TEXT,
-                encoding TEXT NOT NULL,
-                location TEXT NOT NULL,
-                data BLOB,
-                length INTEGER NOT NULL,
-                UNIQUE(uri, encoding),
-                FOREIGN KEY (uri) REFERENCES uris(uri),
-                CHECK (location IN ("DATABASE", "FILESYSTEM"))
-            );
-            CREATE TABLE redirects (
-                uri TEXT ,
-                type TEXT NOT NULL,
-                location TEXT NOT NULL,
-                PRIMARY KEY (uri),
-                FOREIGN KEY (uri) REFERENCES uris(uri),
-                CHECK (type IN ("TEMPORARY", "PERMANENT"))
-            );
-        ''')
+    os.replace(path_temporary, path)
 
-        database_disk = sqlite3.connect("www/database.db")
+## The prefix of the tags and attributes of the msssg namespace.
+PREFIX_MSSSG = "{" + NAMESPACES_DOCUMENT["msssg"] + "}"
 
-        shutil.copy("src/server.php", "www/main.php")
+## The prefix of the tags of the XHTML namespace.
+PREFIX_XHTML = "{" + NAMESPACES_DOCUMENT["xhtml"] + "}"
 
-        if not os.path.exists("msssg"):
-            os.mkdir("msssg")
-        
-        if not os.path.exists("msssg/assets"):
-            os.mkdir("msssg/assets")
-        
-        if os.path.exists("msssg/history_assets.json"):
-            history_assets = json.load(open("msssg/history_assets.json", "r"))
-        else:
-            history_assets = {}
+## Scans the given msssg document for the sub-assets and graphics it depends
+## on, in document order.
+def scan_document(data):
+    document = xml.parse(io.BytesIO(data))
 
-        if os.path.exists("msssg/data_assets.json"):
-            data_assets = json.load(open("msssg/data_assets.json", "r"))
-        else:
-            data_assets = {}
+    assets = []
+    graphics = []
 
-        assets = {}
+    # A single walk finds both; only the few elements within pictures are
+    # looked at twice.
+    for element in document.iter(xml.Element):
+        attributes = element.attrib
 
-        links = json.load(open("src/links.json"))
+        if len(attributes) == 0:
+            continue
 
-        if not "~notfound" in links:
-            raise RuntimeError("Links must contain ~notfound")
+        if PREFIX_MSSSG + "asset" in attributes:
+            assets.append([
+                attributes[attributes[PREFIX_MSSSG + "asset"]],
+                attributes[PREFIX_MSSSG + "type"]
+            ])
 
-        ## Inserts a resource into the database.
-        def insert_resource(data, type, cache, uri="", encoded=True):
-            id = hash(data + uri.encode("UTF-8"))[:LENGTH_ID_ASSET]
+        # TODO implement other qualities
+        elif element.tag == PREFIX_XHTML + "picture" \
+        and attributes.get(PREFIX_MSSSG + "type") == "GRAPHIC":
+            quality = attributes[PREFIX_MSSSG + "quality"]
 
-            if uri == "":
-                uri = "/" + PREFIX_URI_ASSET + base64.urlsafe_b64encode(id).decode("UTF-8").replace("=", "")
-                etag = "\"\""
+            element_img = None
+            for subelement in element.iterdescendants(PREFIX_XHTML + "img", PREFIX_XHTML + "source"):
+                if subelement.tag == PREFIX_XHTML + "source":
+                    raise RuntimeError("Use of source in picture is currently unsupported")
 
-                # TODO I'm not sure I want to make this a hard requirement
-                assert cache == "INDEFINITE"
-            else:
-                etag = "\"" + base64.b85encode(id).decode("UTF-8") + "\""
+                if element_img is None:
+                    element_img = subelement
+                else:
+                    raise RuntimeError("Multiple img in picture")
 
-            database.execute('''
-                INSERT INTO uris (
-                    uri,
-                    action,
-                    cache
-                )
-                VALUES (
-                    ?, "RESOURCE", ?
-                )
-            ''', (uri, cache))
+            if element_img is None:
+                raise RuntimeError("Missing img in picture")
 
-            database.execute('''
-                INSERT INTO resources (
-                    uri,
-                    type,
-                    etag
-                )
-                VALUES (?, ?, ?)
-            ''', (uri, type, etag))
+            graphics.append([element_img.attrib["src"], quality])
 
-            ## Inserts the given encoding into the database.
-            def insert_encoding(data_encoding, encoding):
-                location = "DATABASE"
-                length_data = len(data_encoding)
+    return {
+        "assets": assets,
+        "graphics": graphics,
+    }
 
-                # Decide location for the file.
-                if length_data > THRESHOLD_ENCODING:
-                    # Data is too big to be efficiently handled by the
-                    # database; put it in the filesystem instead.
+## Transforms the given msssg document into an XHTML document, given the URIs
+## of its sub-assets and the graphic assets of its graphics, both in the order
+## `scan_document` found them in.
+def transform_document(data, uris_assets, assets_graphics):
+    document = xml.parse(io.BytesIO(data))
 
-                    # Oh you, Windows...
-                    filename = base64.b32encode(id).decode("UTF-8").replace("=", "")
-                    if encoding != "":
-                        filename += "-" + encoding
-                    path = "resources/" + filename
+    uris_assets = iter(uris_assets)
+    pictures = []
 
-                    file = open("www/" + path, "wb")
-                    file.write(data_encoding)
-                    file.close()
+    # A single walk replaces asset attributes with their generated URIs,
+    # collects the graphics, and makes sure nothing of the msssg namespace is
+    # left over. Only the pictures are revisited, to add their sources.
+    for element in document.iter(xml.Element):
+        if element.tag.startswith(PREFIX_MSSSG):
+            raise RuntimeError("Found tag in msssg namespace: " + element.tag)
 
-                    location = "FILESYSTEM"
-                    data_encoding = path
+        attributes = element.attrib
 
-                database.execute('''
-                    INSERT INTO encodings (
-                        uri,
-                        encoding,
-                        location,
-                        data,
-                        length
-                    )
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (uri, encoding, location, data_encoding, length_data))
+        if len(attributes) == 0:
+            continue
 
-            tasks = []
+        if PREFIX_MSSSG + "asset" in attributes:
+            attribute_subasset = attributes.pop(PREFIX_MSSSG + "asset")
+            del attributes[PREFIX_MSSSG + "type"]
 
-            if encoded:
-                for encoding in ENCODERS_ENCODING.keys():
-                    tasks.append((PTask(encode, (data, encoding)), encoding))
-            
-            insert_encoding(data, "")
+            uri_subasset = next(uris_assets, None)
+            if uri_subasset is None:
+                raise RuntimeError("More assets in document than scanned")
 
-            for task, encoding in tasks:
-                data_encoding = task.wait()
+            attributes[attribute_subasset] = uri_subasset
 
-                # No point if the compressed data is bigger than the original.
-                if len(data_encoding) < len(data):
-                    insert_encoding(data_encoding, encoding)
+        elif element.tag == PREFIX_XHTML + "picture" \
+        and attributes.get(PREFIX_MSSSG + "type") == "GRAPHIC":
+            del attributes[PREFIX_MSSSG + "type"]
 
-            return uri
+            pictures.append((element, attributes.pop(PREFIX_MSSSG + "quality")))
 
-        ## Inserts an asset into the database.
-        def insert_asset(id, data, type, cache, uri="", encoded=True):
-            lock.acquire()
+        for attribute in attributes.keys():
+            if attribute.startswith(PREFIX_MSSSG):
+                raise RuntimeError("Found attribute in msssg namespace: " + attribute)
 
-            if id in assets:
-                raise RuntimeError("Duplicate id: " + id)
-            
-            uri = insert_resource(data, type, cache, uri, encoded)
+    if next(uris_assets, None) is not None:
+        raise RuntimeError("Fewer assets in document than scanned")
 
-            assets[id] = uri
+    if len(pictures) != len(assets_graphics):
+        raise RuntimeError("Graphics in document don't match the scanned ones")
 
-            # Track the URI's history.
-            history_assets[uri] = id
+    # Process graphics.
+    for (element_picture, quality), assets_graphic in zip(pictures, assets_graphics):
+        element_img = next(element_picture.iter(PREFIX_XHTML + "img"))
 
-            lock.release()
-        
-            return uri
-        
-        tasks_renders = {}
+        del element_img.attrib["src"]
+        del element_img.attrib["srcset"]
+        sizes = element_img.attrib.pop("sizes")
 
-        ## Inserts the given image as a series of graphic assets into the
-        ## database.
-        def insert_graphic(path, quality):
-            id = os.path.relpath(path).replace("\\", "/")
+        # TODO sort types based on a metric that considers all
+        # sizes of a source. Do research into what this is.
+        types = sorted(assets_graphic.keys(),
+            key=lambda type: assets_graphic[type][width_fallback(assets_graphic[type])][1]
+        )
 
-            data = data_file(path)
+        for type in types:
+            assets_by_width = assets_graphic[type]
+            srcset = []
 
-            revision_graphic = astropy.time.Time(os.path.getmtime(path), format="unix")
-            revision_graphic.format = "unix_tai"
-            revision_graphic = float(str(revision_graphic))
+            for width in sorted(assets_by_width.keys()):
+                asset = assets_by_width[width]
 
-            formats = []
+                srcset.append(asset[0] + " " + str(width) + "w")
 
-            for type, qualities in QUALITIES_GRAPHIC.items():
-                if quality in qualities:
-                    formats.append((type, quality))
-                # Very high quality is not supported by all lossy formats; use
-                # high quality instead.
-                elif quality == "VERY HIGH" and "HIGH" in qualities:
-                    formats.append((type, "HIGH"))
+            element_source = element_picture.makeelement("source")
+            element_source.attrib["type"] = type
+            element_source.attrib["srcset"] = ", ".join(srcset)
+            element_source.attrib["sizes"] = sizes
 
-            # TODO consider the image's actual width and never attempt to exceed
-            # it.
-            steps = math.floor(WIDTH_MAXIMUM_GRAPHIC / STEP_WIDTH_GRAPHIC)
 
-            tasks = []
-            assets_graphic = {}
 
-            for type, quality in formats:
-                for index_step in range(steps):
-                    width = (index_step + 1) * STEP_WIDTH_GRAPHIC
+            # TODO testing
+            ss = []
+            for width in sorted(assets_by_width.keys()):
+                ss.append(str(assets_by_width[width][1]))
+            strss = "\n".join(ss)
+            element_source.attrib["data-lengths"] = base64.b64encode(strss.encode("UTF-8")).decode("UTF-8")
 
-                    id_asset = id + ";" + type + ";" + str(width) + ";" + quality
 
-                    lock.acquire()
 
-                    if id_asset in tasks_renders:
-                        def run(id_asset):
-                            return tasks_renders[id_asset].wait()
 
-                        tasks.append((
-                            NTask(run, (id_asset,)),
-                            id_asset,
-                            type,
-                            width
-                        ))
-                    else:
-                        def run(id_asset, data, type, width, quality):
-                            # Check if the asset needs updating. Pull from the
-                            # asset cache if not.
-                            if id_asset in data_assets \
-                            and revision_graphic < data_assets[id_asset]["revision"]:
-                                data_conversion = data_file(data_assets[id_asset]["path"])
-                            else:
-                                data_conversion = PTask(
-                                    render_image,
-                                    (data, type, width, quality)
-                                ).wait()
-
-                                filename_data_asset = base64.b32encode(id_asset.encode("UTF-8")).decode("UTF-8").replace("=", "")
-                                path_data_asset = "msssg/assets/" + filename_data_asset
-
-                                file_data_asset = open(path_data_asset, "wb")
-                                file_data_asset.write(data_conversion)
-                                file_data_asset.close()
-
-                                data_assets[id_asset] = {
-                                    "path": path_data_asset,
-                                    "revision": revision,
-                                }
-
-                            # TODO perhaps we may want to encode images?
-                            # Probably worth attempting only for PNGs and JPEGs.
-                            return (
-                                NTask(
-                                    insert_asset,
-                                    (id_asset, data_conversion, type, "INDEFINITE", "", False)
-                                ).wait(),
-                                len(data_conversion)
-                            )
+            element_img.addprevious(element_source)
 
-                        task = NTask(run, (id_asset, data, type, width, quality))
+        # Set the fallback asset.
+        match quality:
+            case "LOSSLESS":
+                type_fallback = "image/png"
+            case _:
+                type_fallback = "image/jpeg"
 
-                        tasks_renders[id_asset] = task
-                        tasks.append((task, id_asset, type, width))
-                    
-                    lock.release()
+        assets_fallback = assets_graphic[type_fallback]
 
-            for task, id_asset, type, width in tasks:
-                if type not in assets_graphic:
-                    assets_graphic[type] = {}
-                
-                assets_graphic[type][width] = task.wait()
+        element_img.attrib["src"] = assets_fallback[width_fallback(assets_fallback)][0]
 
-            return assets_graphic
+    # Drops the msssg namespace declaration, now that nothing uses it.
+    xml.cleanup_namespaces(document)
 
-        ## Inserts a file as an asset into the database.
-        def insert_file(path, type, cache, uri=""):
-            id = os.path.relpath(path).replace("\\", "/")
+    data = xml.tostring(document)
 
-            if id in assets:
-                if uri != "" and uri != assets[id]:
-                    raise RuntimeError("Duplicate URIs for asset")
+    return data
 
-                return assets[id]
+## Takes every element and attribute of the given document out of its
+## namespace, the way HTML has them.
+def strip_namespaces(document):
+    for element in document.iter(xml.Element):
+        element.tag = element.tag.rpartition("}")[2]
 
-            # TODO is this something I'm willing to commit to?
-            assert type != ""
+        for attribute in element.attrib.keys():
+            if attribute.startswith("{"):
+                value = element.attrib.pop(attribute)
+                name = attribute.rpartition("}")[2]
 
-            # TODO parse charset?
+                # `xml:lang` only repeats `lang`, and `xlink:href` is
+                # superseded by `href`.
+                if name not in element.attrib:
+                    element.attrib[name] = value
 
-            match type:
-                # HTML.
-                case "application/msssg+xml;charset=UTF-8":
-                    ## Returns a CSS selector for the current HTML document.
-                    def select(selector):
-                        return cssselect.CSSSelector(
-                            selector,
-                            namespaces={
-                                "xhtml": "http://www.w3.org/1999/xhtml",
-                                "msssg": "http://localhost/msssg"
-                            }
-                        )
+    xml.cleanup_namespaces(document)
 
-                    directory = os.path.dirname(path)
+## Splits the given stylesheet into its rules, without looking into their
+## blocks. Each rule is a tuple of its prelude and its block, or `None` for
+## statements that have no block.
+def split_stylesheet(stylesheet):
+    rules = []
 
-                    document = xml.parse(path)
+    depth = 0
+    start = 0
+    start_block = 0
+    index = 0
 
-                    tasks_assets = []
+    while index < len(stylesheet):
+        character = stylesheet[index]
 
-                    # Replace asset attributes with their generated URIs.
-                    for element in select("[msssg|asset]")(document):
-                        attribute_subasset = element.attrib["{http://localhost/msssg}asset"]
-                        type_subasset = element.attrib["{http://localhost/msssg}type"]
+        if stylesheet.startswith("/*", index):
+            end = stylesheet.find("*/", index + 2)
+            index = len(stylesheet) if end == -1 else end + 2
 
-                        path_subasset = directory + "/" + element.attrib[attribute_subasset]
+            continue
 
-                        tasks_assets.append((
-                            NTask(
-                                insert_file,
-                                (path_subasset, type_subasset, "INDEFINITE")
-                            ),
-                            element
-                        ))
+        if character == "\"" or character == "'":
+            index += 1
 
-                    tasks_graphics = []
-                    
-                    # Process graphics.
-                    # TODO implement other qualities
-                    for element_picture in select("xhtml|picture[msssg|type=\"GRAPHIC\"]")(document):
-                        quality = element_picture.attrib["{http://localhost/msssg}quality"]
-
-                        element_img = None
-                        for subelement in select("xhtml|img")(element_picture):
-                            if element_img is None:
-                                element_img = subelement
-                            else:
-                                raise RuntimeError("Multiple img in picture")
-                            
-                        if element_img is None:
-                            raise RuntimeError("Missing img in picture")
-
-                        for _ in select("xhtml|source")(element_picture):
-                            raise RuntimeError("Use of source in picture is currently unsupported")
-
-                        path_graphic = directory + "/" + element_img.attrib["src"]
-
-                        tasks_graphics.append((
-                            NTask(insert_graphic, (path_graphic, quality)),
-                            element_picture,
-                            element_img
-                        ))
+            while index < len(stylesheet) and stylesheet[index] != character:
+                index += 2 if stylesheet[index] == "\\" else 1
 
-                    for task, element in tasks_assets:
-                        uri_subasset = task.wait()
+        elif character == "\\":
+            index += 1
 
-                        attribute_subasset = element.attrib.pop("{http://localhost/msssg}asset")
-                        del element.attrib["{http://localhost/msssg}type"]
+        elif character == "{":
+            if depth == 0:
+                start_block = index + 1
 
-                        element.attrib[attribute_subasset] = uri_subasset
+            depth += 1
 
-                    for task, element_picture, element_img in tasks_graphics:
-                        assets_graphic = task.wait()
+        elif character == "}" and depth > 0:
+            depth -= 1
 
-                        quality = element_picture.attrib.pop("{http://localhost/msssg}quality")
-                        del element_picture.attrib["{http://localhost/msssg}type"]
-                        del element_img.attrib["src"]
-                        del element_img.attrib["srcset"]
-                        sizes = element_img.attrib.pop("sizes")
+            if depth == 0:
+                rules.append((
+                    prelude_rule(stylesheet[start:start_block - 1]),
+                    stylesheet[start_block:index]
+                ))
+                start = index + 1
 
-                        # TODO sort types based on a metric that considers all
-                        # sizes of a source. Do research into what this is.
-                        types = sorted(assets_graphic.keys(),
-                            key=lambda type: assets_graphic[type][WIDTH_FALLBACK_GRAPHIC][1]
-                        )
+        elif character == ";" and depth == 0:
+            rules.append((prelude_rule(stylesheet[start:index]), None))
+            start = index + 1
 
-                        for type in types:
-                            assets_by_width = assets_graphic[type]
-                            srcset = []
+        index += 1
 
-                            for width in sorted(assets_by_width.keys()):
-                                asset = assets_by_width[width]
+    return [(prelude, block) for prelude, block in rules if prelude != "" or block is not None]
 
-                                srcset.append(asset[0] + " " + str(width) + "w")
-                            
-                            element_source = element_picture.makeelement("source")
-                            element_source.attrib["type"] = type
-                            element_source.attrib["srcset"] = ", ".join(srcset)
-                            element_source.attrib["sizes"] = sizes
+## Returns the given prelude of a rule without its comments and surrounding
+## whitespace.
+def prelude_rule(prelude):
+    return re.sub(r"/\*.*?(\*/|$)", "", prelude, flags=re.DOTALL).strip()
 
+## Returns the given stylesheet with only the style rules whose selectors the
+## given function says match, to be inlined. At-rules are kept; the ones that
+## group style rules have theirs pruned as well.
+def prune_stylesheet(stylesheet, matches):
+    rules = []
 
+    for prelude, block in split_stylesheet(stylesheet):
+        if block is None:
+            # Inlined stylesheets take the document's encoding.
+            if not prelude.lower().startswith("@charset"):
+                rules.append(prelude + ";")
 
-                            # TODO testing
-                            ss = []
-                            for width in sorted(assets_by_width.keys()):
-                                ss.append(str(assets_by_width[width][1]))
-                            strss = "\n".join(ss)
-                            element_source.attrib["data-lengths"] = base64.b64encode(strss.encode("UTF-8")).decode("UTF-8")
+        elif prelude.startswith("@"):
+            name = prelude[1:].split(None, 1)[0].split("(", 1)[0].lower() if len(prelude) > 1 else ""
 
+            match name:
+                case "media" | "supports" | "container":
+                    block = prune_stylesheet(block, matches)
 
+                    if block != "":
+                        rules.append(prelude + "{" + block + "}")
 
+                # Layers are kept even when empty, since they still order
+                # the others.
+                case "layer":
+                    rules.append(prelude + "{" + prune_stylesheet(block, matches) + "}")
 
-                            element_img.addprevious(element_source)
-                        
-                        # Set the fallback asset.
-                        match quality:
-                            case "LOSSLESS":
-                                element_img.attrib["src"] = assets_graphic["image/png"][WIDTH_FALLBACK_GRAPHIC][0]
-                            case _:
-                                element_img.attrib["src"] = assets_graphic["image/jpeg"][WIDTH_FALLBACK_GRAPHIC][0]
+                case _:
+                    rules.append(prelude + "{" + block + "}")
 
-                    xml.cleanup_namespaces(document)
+        elif matches(prelude):
+            rules.append(prelude + "{" + block + "}")
 
-                    # Sanity checks: make sure msssg namespace doesn't appear in
-                    # the final HTML document.
-                    for element in select("msssg|*")(document):
-                        raise RuntimeError("Found tag in msssg namespace: " + element.tag)
-                    for element in select("*")(document):
-                        for attribute in element.attrib.keys():
-                            if "{http://localhost/msssg}" in attribute:
-                                raise RuntimeError("Found attribute in msssg namespace: " + attribute)
+    return "\n".join(rules)
 
-                    data = xml.tostring(document)
-                    type = "application/xhtml+xml;charset=UTF-8"
+## Compiled CSS selectors, by thread. Selectors are locked while they run, so
+## sharing them between threads would have every page wait on every other.
+selectors = threading.local()
 
-                    # document = html.document_fromstring(data)
+## Returns the classes and IDs of the elements of the given document, as
+## `.class` and `#id`.
+def names_document(document):
+    names = set()
 
-                    # for attribute in [
-                    #     "xmlns",
-                    #     "xml:lang",
-                    # ]:
-                    #     if attribute in document.attrib:
-                    #         del document.attrib[attribute]
-                        
-                    # data = html.tostring(document, doctype="<!DOCTYPE html>")
+    for element in document.iter(xml.Element):
+        for name in element.attrib.get("class", "").split():
+            names.add("." + name)
 
-                    # data = minify_html.minify(data.decode("UTF-8"),
-                    #     minify_css=True,
-                    # )
-                    # data = data.encode("UTF-8")
+        if "id" in element.attrib:
+            names.add("#" + element.attrib["id"])
 
-                    # type = "text/html;charset=UTF-8"
-                    #
+    return names
 
+## Returns whether the given selector matches any element of the given
+## document, which is without namespaces and has the given classes and IDs.
+## Selectors that can't be told are taken to match.
+def matches_selector(document, names, selector):
+    # A selector can't match without every class and ID it requires, outside
+    # of its functional pseudo-classes and attribute selectors. Testing that
+    # first spares most rules that don't match from the XPath.
+    if "\\" not in selector:
+        required = selector
 
-                case _:
-                    data = data_file(path)
+        while True:
+            stripped = re.sub(r"\([^()]*\)|\[[^\[\]]*\]", "", required)
 
-            return insert_asset(id, data, type, cache, uri)
+            if stripped == required:
+                break
 
+            required = stripped
 
+        if all(
+            any(name not in names for name in re.findall(r"[.#][\w-]+", alternative))
+            for alternative in required.split(",")
+        ):
+            return False
 
-        
+    if not hasattr(selectors, "compiled"):
+        selectors.compiled = {}
+
+    if selector not in selectors.compiled:
+        try:
+            selectors.compiled[selector] = cssselect.CSSSelector(
+                PATTERN_DYNAMIC_SELECTOR.sub("", selector),
+                translator="html"
+            )
+        except cssselect.SelectorError:
+            selectors.compiled[selector] = None
+
+    if selectors.compiled[selector] is None:
+        return True
+
+    return len(selectors.compiled[selector](document)) > 0
+
+## Returns whether the given stylesheet means the same wherever it is, because
+## every URL in it is absolute.
+def is_relocatable(stylesheet):
+    for url in re.findall(
+        r"url\(\s*[\"']?([^\"')\s]*)|@import\s+[\"']([^\"']*)",
+        stylesheet,
+        flags=re.IGNORECASE
+    ):
+        url = url[0] or url[1]
+
+        if not url.startswith(("/", "#", "data:")) and "://" not in url:
+            return False
+
+    return True
+
+## Inlines the given stylesheets, by URI, into the given XHTML document in place
+## of the links to them, with only the rules that match the document's elements.
+## Stylesheets that would still be too long, or that can't be moved, stay
+## linked.
+def inline_stylesheets(data, stylesheets):
+    document = xml.parse(io.BytesIO(data))
+
+    # Stylesheets match against the document the way browsers see it.
+    document_matching = xml.parse(io.BytesIO(data))
+    strip_namespaces(document_matching)
+
+    names = names_document(document_matching)
+
+    ## Returns whether the given selector matches any element of the document.
+    def matches(selector):
+        return matches_selector(document_matching, names, selector)
+
+    for element in list(document.iter(PREFIX_XHTML + "link")):
+        if "stylesheet" not in element.attrib.get("rel", "").lower().split() \
+        or element.attrib.get("href") not in stylesheets:
+            continue
+
+        try:
+            stylesheet = stylesheets[element.attrib["href"]].decode("UTF-8")
+        except UnicodeDecodeError:
+            continue
+
+        if not is_relocatable(stylesheet):
+            continue
+
+        stylesheet = prune_stylesheet(stylesheet, matches)
+
+        if len(stylesheet.encode("UTF-8")) > LENGTH_INLINE_STYLESHEET:
+            continue
+
+        element_style = element.makeelement(PREFIX_XHTML + "style")
+        element_style.text = stylesheet
+        element_style.tail = element.tail
+
+        if "media" in element.attrib:
+            element_style.attrib["media"] = element.attrib["media"]
+
+        element.getparent().replace(element, element_style)
+
+    return xml.tostring(document)
+
+## Turns the given XHTML document into the equivalent HTML document.
+def html_document(data):
+    document = xml.parse(io.BytesIO(data))
+
+    # HTML has no namespaces; its parser puts SVG and MathML elements back into
+    # theirs by itself.
+    strip_namespaces(document)
+
+    # The HTML serializer closes elements the way HTML parsers expect them to
+    # be, rather than self-closing them.
+    return html.tostring(document, encoding="unicode", doctype="<!DOCTYPE html>")
+
+## Minifies the given data of a resource of the given type. Documents come out
+## as HTML.
+def minify(data, type):
+    if type.startswith("application/xhtml+xml"):
+        return minify_html.minify(html_document(data), minify_css=True).encode("UTF-8")
+
+    if type.startswith("text/css"):
+        try:
+            stylesheet = data.decode("UTF-8")
+        except UnicodeDecodeError:
+            return data
+
+        # Stylesheets are only minified within documents.
+        minified = minify_html.minify("<style>" + stylesheet + "</style>", minify_css=True)
+
+        if not minified.startswith("<style>") or not minified.endswith("</style>"):
+            return data
+
+        minified = minified[len("<style>"):-len("</style>")].encode("UTF-8")
+
+        return minified if len(minified) < len(data) else data
+
+    raise RuntimeError("Unminifiable type: " + type)
 
+## Returns the type of a resource of the given type once it is minified.
+def type_minified(type):
+    if type.startswith("application/xhtml+xml"):
+        return "text/html;charset=UTF-8"
 
+    return type
 
+## Returns the widths to render a graphic image of the given source width at:
+## every step up to the source width or the maximum width, whichever is smaller,
+## plus the source width itself if it is narrower than the maximum width.
+def widths_graphic(width_source):
+    width_maximum = min(width_source, WIDTH_MAXIMUM_GRAPHIC)
+
+    widths = list(range(STEP_WIDTH_GRAPHIC, width_maximum + 1, STEP_WIDTH_GRAPHIC))
+
+    if width_maximum not in widths:
+        widths.append(width_maximum)
+
+    return widths
+
+## Returns the width of the fallback among the given rendered widths.
+def width_fallback(widths):
+    return max(width for width in widths if width <= WIDTH_FALLBACK_GRAPHIC)
+
+## Compresses the given data with zlib at the highest level, with the given
+## window bits (which also pick the container) and strategy.
+def compress_zlib(data, bits, strategy):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, bits, 9, strategy)
+
+    return compressor.compress(data) + compressor.flush()
+
+## Encodes the given data using the given encoding method, keeping the smallest
+## result of all of its candidate encoders.
+def encode(data, encoding):
+    datas = []
+
+    for name, encoder in ENCODERS_ENCODING[encoding].items():
+        with span(name, {"length": len(data)}):
+            datas.append(encoder(data))
+
+    return min(datas, key=len)
+
+## Trains a dictionary of the given samples. Returns `None` if there isn't
+## enough to train one on.
+def train_dictionary(samples):
+    try:
+        return zstandard.train_dictionary(SIZE_DICTIONARY, samples).as_bytes()
+    except zstandard.ZstdError:
+        return None
+
+## Encodes the given data as `dcz` with the given dictionary: a zstd frame
+## compressed with the dictionary, behind a header naming the dictionary by its
+## hash.
+def encode_dictionary(data, dictionary):
+    compressor = zstandard.ZstdCompressor(
+        dict_data=zstandard.ZstdCompressionDict(
+            dictionary,
+            dict_type=zstandard.DICT_TYPE_RAWCONTENT
+        ),
+        compression_params=zstandard.ZstdCompressionParameters.from_level(
+            22,
+            window_log=23,
+            write_dict_id=0
+        )
+    )
+
+    return b"\x5E\x2A\x4D\x18\x20\x00\x00\x00" \
+        + hashlib.sha256(dictionary).digest() \
+        + compressor.compress(data)
+
+## Decodes the given image data into shared memory so that pool processes can
+## all render from the same pixels without decoding or pickling them again.
+## Returns the shared memory along with a description of the image to pass to
+## `open_image`. The caller is responsible for unlinking the shared memory.
+def share_image(data):
+    image = PIL.Image.open(io.BytesIO(data))
+
+    # Palettes don't survive the trip through a raw buffer, and nothing should
+    # be resized in palette mode anyway.
+    if image.mode in ("P", "PA"):
+        if image.mode == "PA" or "transparency" in image.info:
+            image = image.convert("RGBA")
+        else:
+            image = image.convert("RGB")
+
+    pixels = image.tobytes()
+
+    memory = multiprocessing.shared_memory.SharedMemory(
+        create=True,
+        size=max(len(pixels), 1)
+    )
+    memory.buf[:len(pixels)] = pixels
+
+    description = (memory.name, image.mode, image.size)
+
+    image.close()
+
+    return memory, description
+
+## Opens the image shared by `share_image` with the given description, without
+## copying its pixels. Returns the shared memory along with the image; close
+## the image before closing the shared memory.
+def open_image(description):
+    name, mode, size = description
+
+    memory = multiprocessing.shared_memory.SharedMemory(name=name)
+
+    # Attaching registers the memory with this process's resource tracker as if
+    # it owned it, which would then "clean up" the memory from under everyone
+    # else once the process exits.
+    if os.name == "posix":
+        multiprocessing.resource_tracker.unregister(memory._name, "shared_memory")
+
+    image = PIL.Image.frombuffer(mode, size, memory.buf, "raw", mode, 0, 1)
+
+    return memory, image
+
+## Returns the encoder quality setting to render the given type with at the
+## given quality and width.
+def quality_render(type, quality, width):
+    assert isinstance(width, int) or width.is_integer()
 
+    match quality:
+        case "VERY LOW" | "LOW" | "MEDIUM" | "HIGH" | "VERY HIGH" | "LOSSLESS":
+            pass
+        case _:
+            raise RuntimeError("Unknown quality: " + quality)
+    if not quality in QUALITIES_GRAPHIC[type]:
+        raise RuntimeError("Unsupported quality for " + type + ": " + quality)
 
+    definition_quality = QUALITIES_GRAPHIC[type][quality]
 
+    if isinstance(definition_quality, dict):
+        widths = sorted(definition_quality.keys())
         
+        index_width = bisect.bisect_right(widths, width)
+
+        # Calculate interpolant.
+        if index_width == 0:
+            value_quality = definition_quality[widths[0]]
+        elif index_width == len(widths):
+            value_quality = definition_quality[widths[len(widths) - 1]]
+        else:
+            value_quality = round(
+                definition_quality[widths[index_width - 1]] \
+                + (definition_quality[widths[index_width]] - definition_quality[widths[index_width - 1]]) \
+                    * (width - widths[index_width - 1]) \
+                    / (widths[index_width] - widths[index_width - 1])
+            )
+    else:
+        value_quality = definition_quality
+
+    return value_quality
+
+## Returns the pixels of the given image in a mode imagecodecs' encoders take.
+def pixels_codec(image):
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+    return numpy.asarray(image)
+
+## Encodes the given image as the given type with the given quality, or with the
+## given encoder quality setting if there is one.
+def encode_image(image, type, quality, value_quality=None):
+    if value_quality is None:
+        value_quality = quality_render(type, quality, image.width)
+
+    # Renders are made from raw pixels, so none of the source's metadata makes
+    # it into them.
+
+    output = io.BytesIO()
+
+    match type:
+        case "image/png":
+            image.save(output, format="PNG", optimize=True)
+        case "image/jpeg":
+            datas = []
+
+            # Progressive scans usually come out smaller, but not always.
+            for progressive in [False, True] if OPTIMIZING_GRAPHIC else [False]:
+                output_jpeg = io.BytesIO()
+
+                image.save(
+                    output_jpeg,
+                    format="JPEG",
+                    quality=value_quality,
+                    optimize=True,
+                    progressive=progressive
+                )
+
+                datas.append(output_jpeg.getvalue())
+
+            output.write(min(datas, key=len))
+        # case "image/jpeg2000":
+        #     image.save(output, format="JPEG2000", irreversible=False)
+        case "image/webp":
+            if quality == "LOSSLESS":
+                image.save(output, format="WebP", lossless=True, quality=100, method=6)
+            else:
+                image.save(output, format="WebP", quality=value_quality, method=6)
+        case "image/avif":
+            if imagecodecs is None:
+                raise RuntimeError("Encoding image/avif requires imagecodecs")
+
+            # Lossless: full chroma and no color transform.
+            output.write(imagecodecs.avif_encode(
+                pixels_codec(image),
+                100,
+                speed=0,
+                pixelformat=imagecodecs.AVIF.PIXEL_FORMAT.YUV444,
+                matrix=imagecodecs.AVIF.MATRIX_COEFFICIENTS.IDENTITY,
+                numthreads=COUNT_THREADS_ENCODER
+            ))
+
+        case "image/jxl":
+            if imagecodecs is None:
+                raise RuntimeError("Encoding image/jxl requires imagecodecs")
+
+            output.write(imagecodecs.jpegxl_encode(
+                pixels_codec(image),
+                lossless=True,
+                effort=9,
+                numthreads=COUNT_THREADS_ENCODER
+            ))
+
+        case _:
+            raise RuntimeError("Unknown type " + type)
+
+    data = output.getvalue()
+
+    output.close()
+
+    return data
+
+## Returns a PNG chunk of the given kind with the given data.
+def chunk_png(kind, data):
+    return struct.pack(">I", len(data)) + kind + data \
+        + struct.pack(">I", zlib.crc32(kind + data))
+
+## Returns the given rows of PNG scanline bytes with `bpp` bytes per pixel
+## filtered with each of the five filter types. Every filter only looks at the
+## unfiltered bytes, so all rows are filtered at once.
+def filters_png(rows, bpp):
+    x = rows.astype(numpy.int16)
+
+    a = numpy.zeros_like(x)
+    a[:, bpp:] = x[:, :-bpp]
+    b = numpy.zeros_like(x)
+    b[1:] = x[:-1]
+    c = numpy.zeros_like(x)
+    c[1:, bpp:] = x[:-1, :-bpp]
+
+    p = a + b - c
+    pa = numpy.abs(p - a)
+    pb = numpy.abs(p - b)
+    pc = numpy.abs(p - c)
+    paeth = numpy.where((pa <= pb) & (pa <= pc), a, numpy.where(pb <= pc, b, c))
+
+    return numpy.stack([x, x - a, x - b, x - (a + b) // 2, x - paeth]).astype(numpy.uint8)
+
+## Losslessly recompresses the given PNG, trying it in the smallest pixel formats
+## that hold its pixels exactly, with uniform and adaptive filtering and a few
+## zlib strategies. Returns the smallest PNG of all, which may be the given one.
+def optimize_png(data):
+    with PIL.Image.open(io.BytesIO(data)) as image:
+        if image.mode not in ("L", "LA", "RGB", "RGBA"):
+            return data
+
+        pixels = numpy.asarray(image)
+
+    if pixels.ndim == 2:
+        pixels = pixels[..., numpy.newaxis]
+
+    height, width, _ = pixels.shape
+
+    # Drop an alpha channel that is opaque throughout, and color channels that
+    # are all the same.
+    if pixels.shape[2] in (2, 4) and (pixels[..., -1] == 255).all():
+        pixels = pixels[..., :-1]
+
+    if pixels.shape[2] >= 3 \
+    and (pixels[..., 0] == pixels[..., 1]).all() \
+    and (pixels[..., 1] == pixels[..., 2]).all():
+        pixels = pixels[..., [0] + ([3] if pixels.shape[2] == 4 else [])]
+
+    channels = pixels.shape[2]
+
+    # Each a tuple of the header, the chunks between the header and the image
+    # data, the scanline bytes and the bytes per pixel.
+    formats = [(
+        struct.pack(">IIBBBBB", width, height, 8, [0, 4, 2, 6][channels - 1], 0, 0, 0),
+        b"",
+        pixels.reshape(height, width * channels),
+        channels
+    )]
+
+    # Every pixel as one number, to count the colors by.
+    keys = numpy.zeros((height, width), numpy.uint32)
+    for channel in range(channels):
+        keys |= pixels[..., channel].astype(numpy.uint32) << (8 * channel)
+
+    colors, indices = numpy.unique(keys, return_inverse=True)
+
+    if len(colors) <= 256:
+        palette = numpy.zeros((len(colors), 4), numpy.uint8)
+        palette[:, 3] = 255
+
+        for channel in range(channels):
+            palette[:, channel] = (colors >> (8 * channel)) & 0xFF
+
+        # Gray pixels are stored as a single channel.
+        if channels <= 2:
+            palette[:, 3] = palette[:, 1] if channels == 2 else 255
+            palette[:, 1] = palette[:, 0]
+            palette[:, 2] = palette[:, 0]
+
+        # Translucent colors first, so that their alphas can end early.
+        order = numpy.argsort(palette[:, 3] == 255, kind="stable")
+        palette = palette[order]
+        indices = numpy.argsort(order)[indices.reshape(height, width)].astype(numpy.uint8)
+
+        depth = next(depth for depth in [1, 2, 4, 8] if len(colors) <= 1 << depth)
+
+        # Pack the pixels of each row into as few bytes as the depth allows.
+        per_byte = 8 // depth
+        width_padded = -(-width // per_byte) * per_byte
+
+        indices_padded = numpy.zeros((height, width_padded), numpy.uint8)
+        indices_padded[:, :width] = indices
+        indices_padded = indices_padded.reshape(height, width_padded // per_byte, per_byte)
+
+        rows = numpy.zeros((height, width_padded // per_byte), numpy.uint8)
+        for index in range(per_byte):
+            rows |= indices_padded[..., index] << (8 - depth * (index + 1))
+
+        count_translucent = int((palette[:, 3] != 255).sum())
+
+        chunks = chunk_png(b"PLTE", palette[:, :3].tobytes())
+        if count_translucent > 0:
+            chunks += chunk_png(b"tRNS", palette[:count_translucent, 3].tobytes())
+
+        formats.append((
+            struct.pack(">IIBBBBB", width, height, depth, 3, 0, 0, 0),
+            chunks,
+            rows,
+            1
+        ))
+
+    candidates = [data]
+
+    for header, chunks, rows, bpp in formats:
+        filtered = filters_png(rows, bpp)
+
+        # Each row filtered whichever way leaves the smallest bytes, by the
+        # usual minimum sum of absolute differences heuristic.
+        costs = numpy.abs(filtered.astype(numpy.int8).astype(numpy.int16)).sum(axis=2)
+        choices = [
+            numpy.full(height, type_filter, numpy.uint8)
+            for type_filter in {0, int(costs.sum(axis=1).argmin())}
+        ] + [costs.argmin(axis=0).astype(numpy.uint8)]
+
+        ## Returns the PNG of the rows filtered by the given choices, with the
+        ## given zlib strategy.
+        def png(choice, strategy):
+            scanlines = numpy.empty((height, rows.shape[1] + 1), numpy.uint8)
+            scanlines[:, 0] = choice
+            scanlines[:, 1:] = filtered[choice, numpy.arange(height)]
+
+            return b"\x89PNG\r\n\x1a\n" \
+                + chunk_png(b"IHDR", header) \
+                + chunks \
+                + chunk_png(b"IDAT", compress_zlib(scanlines.tobytes(), 15, strategy)) \
+                + chunk_png(b"IEND", b"")
+
+        # Pick the filtering first, and only then try the other strategies on
+        # it.
+        candidates_format = [
+            (png(choice, zlib.Z_DEFAULT_STRATEGY), choice)
+            for choice in choices
+        ]
+        _, choice = min(candidates_format, key=lambda candidate: len(candidate[0]))
+
+        candidates += [candidate for candidate, _ in candidates_format]
+        candidates += [png(choice, strategy) for strategy in [zlib.Z_FILTERED, zlib.Z_RLE]]
+
+    return min(candidates, key=len)
+
+## Returns the SSIM target to search for the encoder quality setting of the
+## given type and quality with, or `None` if it isn't to be searched for.
+def target_render(type, quality):
+    if not SEARCH_QUALITY_GRAPHIC or type not in RANGES_QUALITY_GRAPHIC:
+        return None
+
+    return TARGETS_SSIM_GRAPHIC.get(quality)
+
+## Calculates the mean SSIM between the given 8-bit images, using the same
+## defaults as scikit-image: a 7x7 uniform window, K1 = 0.01, K2 = 0.03 and the
+## sample covariance. The last two axes are the height and width, or the last
+## three if the images have channels; any leading axes are batched over.
+def ssim(a, b, channels=True):
+    if not channels:
+        a = a[..., numpy.newaxis]
+        b = b[..., numpy.newaxis]
+
+    size = 7
+    count = size * size
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    ## Returns the means of every window over the given image.
+    def mean(image):
+        # Integral image with a leading row and column of zeroes.
+        integral = numpy.zeros(
+            image.shape[:-2] + (image.shape[-2] + 1, image.shape[-1] + 1)
+        )
+        integral[..., 1:, 1:] = image.cumsum(-2).cumsum(-1)
+
+        return (
+            integral[..., size:, size:]
+            - integral[..., :-size, size:]
+            - integral[..., size:, :-size]
+            + integral[..., :-size, :-size]
+        ) / count
+
+    means = []
+
+    # One channel at a time keeps the memory down on big renders.
+    for channel in range(a.shape[-1]):
+        x = a[..., channel].astype(numpy.float64)
+        y = b[..., channel].astype(numpy.float64)
+
+        mean_x = mean(x)
+        mean_y = mean(y)
+
+        normalization = count / (count - 1)
+        variance_x = normalization * (mean(x * x) - mean_x * mean_x)
+        variance_y = normalization * (mean(y * y) - mean_y * mean_y)
+        covariance = normalization * (mean(x * y) - mean_x * mean_y)
+
+        s = ((2 * mean_x * mean_y + c1) * (2 * covariance + c2)) \
+            / ((mean_x * mean_x + mean_y * mean_y + c1) * (variance_x + variance_y + c2))
+
+        means.append(s.mean(axis=(-2, -1)))
+
+    return numpy.mean(means, axis=0)
+
+## Encodes the given image as the given type with the lowest encoder quality
+## setting that still meets the given SSIM target, by bisection. Returns the
+## encoded image and the setting it was encoded with.
+def search_quality(image, type, target):
+    reference = numpy.asarray(image)
+
+    ## Returns whether the given render meets the target.
+    def meets(data):
+        with PIL.Image.open(io.BytesIO(data)) as image_render:
+            render = numpy.asarray(image_render.convert(image.mode))
+
+        return ssim(reference, render, reference.ndim == 3) >= target
+
+    low, high = RANGES_QUALITY_GRAPHIC[type]
+
+    # Even the highest setting may not make it; settle for that then.
+    data = encode_image(image, type, None, high)
+
+    while low < high:
+        middle = (low + high) // 2
+
+        data_middle = encode_image(image, type, None, middle)
+
+        if meets(data_middle):
+            high = middle
+            data = data_middle
+        else:
+            low = middle + 1
+
+    return data, high
+
+## Rerenders the image shared with the given description with each of the
+## given specifications, each a tuple of a type, a quality, a width and an
+## encoder quality setting, if one is already known. Every width is only resized
+## to once, no matter how many types it is rendered as. Returns the rendered
+## images and their encoder quality settings in the order of the
+## specifications.
+def render_images(source, specifications):
+    memory, image_source = open_image(source)
+
+    aspect = image_source.width / image_source.height
+
+    datas = [None] * len(specifications)
+
+    # Images to resize from, widest first.
+    levels = [image_source]
+
+    for width in sorted({width for _, _, width, _ in specifications}, reverse=True):
+        assert isinstance(width, int) or width.is_integer()
+
+        if width > image_source.width:
+            # TODO maybe this should only be a warning instead?
+            raise RuntimeError("Rendered image resolution limited by source resolution")
+
+        if width == image_source.width:
+            image = image_source
+        else:
+            # Resize from the smallest level that is still wide enough not to
+            # cost any quality. Widths only get smaller from here, so anything
+            # wider than that is never going to be needed again.
+            if GAP_PYRAMID_GRAPHIC is not None:
+                while len(levels) > 1 \
+                and levels[1].width >= GAP_PYRAMID_GRAPHIC * width:
+                    levels.pop(0).close()
+
+            height = round(width / aspect)
+
+            with span("resize", {"width": width, "from": levels[0].width}):
+                image = levels[0].resize((width, height), PIL.Image.LANCZOS)
 
+        for index, (type, quality, width_specification, value_quality) \
+        in enumerate(specifications):
+            if width_specification != width:
+                continue
 
-        # FOR STRESS TESTING
-
-        # for index in range(9900, 10000, 1):
-        #     links["/test/" + str(index + 1)] = {
-        #         "action": "RESOURCE",
-        #         # "path": "src/www/test.html",
-        #         "path": "src/exwww/testk/" + str(index + 1),
-        #         "type": "text/plain;charset=UTF-8",
-        #         "cache": "SHORT",
-        #     }
-        # for path in [
-        #     # "src/www/tiff.png",
-        #     # "src/www/cherry.png",
-        #     # "src/www/louise.png",
-        #     # "src/www/lake.png",
-        #     "src/www/about.html"
-        # ]:
-        #     data = b""
-        #     file = open(path, "rb")
-        #     while buffer := file.read():
-        #         data += buffer
-        #     file.close()
-
-        #     insert_asset(path + ";source", data, "text/html", "INDEFINITE")
-        #     # insert_image(data)
+            target = target_render(type, quality)
+
+            with span(type, {"width": width, "quality": quality}):
+                if value_quality is None and target is not None:
+                    datas[index] = search_quality(image, type, target)
+                else:
+                    datas[index] = (
+                        encode_image(image, type, quality, value_quality),
+                        value_quality
+                    )
+
+        if image is not image_source:
+            if GAP_PYRAMID_GRAPHIC is not None:
+                levels.append(image)
+            else:
+                image.close()
+
+    for level in levels[1:]:
+        level.close()
+    image_source.close()
+    memory.close()
+
+    return datas
+
+## Writes the given spans of a build that took the given duration in seconds
+## out as a trace and a summary, and prints the gist of the summary. Spans name
+## their asset by its ID or URI; the given IDs by URI tell which is which.
+def write_profile(spans, duration, ids_uris):
+    time_origin = min(time_start for _, _, _, _, _, time_start, _ in spans)
+
+    pid_main = os.getpid()
+
+    events = []
+
+    for pid in sorted({pid for _, _, _, pid, _, _, _ in spans}):
+        events.append({
+            "name": "process_name",
+            "ph": "M",
+            "pid": pid,
+            "args": {"name": "Builder" if pid == pid_main else "Worker " + str(pid)},
+        })
+
+    stages = {}
+    assets = {}
+    busy = 0
+    wait = 0
+    count_ptasks = 0
+
+    for name, category, details, pid, tid, time_start, time_end in spans:
+        duration_span = time_end - time_start
+
+        arguments = dict(details)
+        if "wait" in arguments:
+            arguments["wait"] = round(arguments["wait"] * 1000, 3)
+
+        events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (time_start - time_origin) * 1000000,
+            "dur": duration_span * 1000000,
+            "pid": pid,
+            "tid": tid,
+            "args": arguments,
+        })
+
+        key = category + " " + name
+        if key not in stages:
+            stages[key] = {"count": 0, "total": 0, "maximum": 0, "wait": 0}
+
+        stages[key]["count"] += 1
+        stages[key]["total"] += duration_span
+        stages[key]["maximum"] = max(stages[key]["maximum"], duration_span)
+        stages[key]["wait"] += details.get("wait", 0)
+
+        if category == "ptask":
+            busy += duration_span
+            wait += details["wait"]
+            count_ptasks += 1
+
+        # Only actual work counts towards an asset; n-tasks mostly wait on
+        # other tasks.
+        if "asset" in details and category in ("stage", "ptask"):
+            asset = ids_uris.get(details["asset"], details["asset"])
+
+            assets[asset] = assets.get(asset, 0) + duration_span
+
+    json.dump(
+        {"traceEvents": events, "displayTimeUnit": "ms"},
+        open(PATH_TRACE_PROFILE, "w")
+    )
+
+    slowest = sorted(assets.items(), key=lambda item: -item[1])[:COUNT_SLOWEST_PROFILE]
+
+    summary = {
+        "duration": duration,
+        "pool": {
+            "processes": COUNT_PROCESSES,
+            "utilization": busy / (COUNT_PROCESSES * duration),
+            "wait": wait / count_ptasks if count_ptasks > 0 else 0,
+        },
+        "stages": dict(sorted(stages.items(), key=lambda item: -item[1]["total"])),
+        "slowest": [{"asset": asset, "duration": total} for asset, total in slowest],
+    }
+
+    json.dump(summary, open(PATH_SUMMARY_PROFILE, "w"), indent=4)
+
+    print(
+        "Pool utilization " + format(summary["pool"]["utilization"] * 100, ".1f") + "%"
+        + ", mean p-task wait " + format(summary["pool"]["wait"] * 1000, ".1f") + " ms"
+    )
+
+    print("Slowest stages:")
+    for key, stage in list(summary["stages"].items())[:10]:
+        print(
+            format(stage["total"], ".3f").rjust(10) + " s  "
+            + str(stage["count"]).rjust(6) + "x  " + key
+        )
+
+    print("Slowest assets:")
+    for asset, total in slowest[:10]:
+        print(format(total, ".3f").rjust(10) + " s  " + asset)
+
+    print("Wrote " + PATH_TRACE_PROFILE + " and " + PATH_SUMMARY_PROFILE)
+
+def main():
+    global spans
+
+    try:
+        time_start = time.monotonic()
+
+        if "--profile" in sys.argv[1:]:
+            spans = []
+
+        time_phase = time.perf_counter()
+
+        animator = multiprocessing.Process(target=animate)
+        animator.start()
+
+        pool = multiprocessing.Pool(
+            COUNT_PROCESSES,
+            initializer=initializer,
+            initargs=(spans is not None,)
+        )
+
+        scheduler = Scheduler(pool, COUNT_PROCESSES, COUNT_THREADS)
+
+        lock = threading.Lock()
+
+        if not os.path.exists("msssg"):
+            os.mkdir("msssg")
         
+        if os.path.exists("msssg/history_assets.json"):
+            history_assets = json.load(open("msssg/history_assets.json", "r"))
+        else:
+            history_assets = {}
+
+        if os.path.exists("msssg/graph.json"):
+            graph = json.load(open("msssg/graph.json", "r"))
+        else:
+            graph = None
+
+        assets = {}
+
+        links = json.load(open(PATH_LINKS))
+
+        if not "~notfound" in links:
+            raise RuntimeError("Links must contain ~notfound")
+
+        # The build is staged as a new release next to the live one, so the
+        # live one keeps being served until this one is complete.
+        path_previous = os.path.realpath(PATH_SITE) \
+            if os.path.exists(PATH_SITE + "/" + PATH_DATABASE) \
+            else None
+
+        if not os.path.exists(PATH_RELEASES):
+            os.makedirs(PATH_RELEASES)
+
+        # Releases that never got published are left over from failed builds.
+        for name in os.listdir(PATH_RELEASES):
+            path = os.path.realpath(PATH_RELEASES + "/" + name)
+
+            if path != path_previous and not os.path.exists(path + "/" + PATH_DATABASE):
+                shutil.rmtree(path)
+
+        path_release = PATH_RELEASES + "/" + str(time.time_ns())
+
+        os.mkdir(path_release)
+        os.mkdir(path_release + "/" + PATH_RESOURCES)
+
+        # Patch the previous build instead of starting over, so long as it was
+        # built the same way.
+        patching = graph is not None \
+            and graph["settings"] == fingerprint_settings() \
+            and path_previous is not None
+
+        path_database = path_release + "/" + PATH_DATABASE
+        path_database_building = path_database + "-building"
+
+        database = sqlite3.connect(
+            path_database_building if STREAMING_DATABASE else ":memory:",
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False
+        )
+
+        if patching:
+            database_disk = sqlite3.connect(path_previous + "/" + PATH_DATABASE)
+            with span("backup"):
+                database_disk.backup(database, sleep=0)
+            database_disk.close()
+
+        database.executescript('''
+            PRAGMA foreign_keys = 1;
+            PRAGMA analysis_limit = 0;
+        ''')
+
+        if STREAMING_DATABASE:
+            database.executescript('''
+                PRAGMA journal_mode = WAL;
+                PRAGMA synchronous = NORMAL;
+            ''')
+
+        if not patching:
+            database.executescript('''
+                CREATE TABLE uris (
+                    uri TEXT,
+                    action TEXT NOT NULL,
+                    cache TEXT NOT NULL,
+                    PRIMARY KEY (uri),
+                    CHECK (action IN ("RESOURCE", "REDIRECT", "DELETION")),
+                    CHECK (cache IN ("NONE", "SHORT", "MEDIUM", "LONG", "INDEFINITE"))
+                );
+                CREATE TABLE resources (
+                    uri TEXT,
+                    type TEXT NOT NULL,
+                    etag TEXT NOT NULL,
+                    PRIMARY KEY (uri),
+                    FOREIGN KEY (uri) REFERENCES uris(uri)
+                );
+                CREATE TABLE encodings (
+                    uri TEXT,
+                    encoding TEXT NOT NULL,
+                    location TEXT NOT NULL,
+                    data BLOB,
+                    length INTEGER NOT NULL,
+                    UNIQUE(uri, encoding),
+                    FOREIGN KEY (uri) REFERENCES uris(uri),
+                    CHECK (location IN ("DATABASE", "FILESYSTEM"))
+                );
+                CREATE TABLE redirects (
+                    uri TEXT ,
+                    type TEXT NOT NULL,
+                    location TEXT NOT NULL,
+                    PRIMARY KEY (uri),
+                    FOREIGN KEY (uri) REFERENCES uris(uri),
+                    CHECK (type IN ("TEMPORARY", "PERMANENT"))
+                );
+            ''')
+
+        # The serving tables may not exist yet in a build being patched.
+        database.executescript('''
+            CREATE INDEX IF NOT EXISTS encodings_length ON encodings (uri, length);
+            CREATE TABLE IF NOT EXISTS metadata (
+                key TEXT,
+                value TEXT NOT NULL,
+                PRIMARY KEY (key)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS negotiations (
+                uri TEXT,
+                rank INTEGER,
+                encoding TEXT,
+                dictionary TEXT,
+                status INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                headers_content TEXT,
+                etag TEXT,
+                PRIMARY KEY (uri, rank),
+                FOREIGN KEY (uri) REFERENCES uris(uri)
+            ) WITHOUT ROWID;
+        ''')
+
+        # Resources kept by patching are encoded with the previous dictionary,
+        # so keep using that one until enough has changed to train it again.
+        dictionary_previous = None
+        metadata_dictionary_previous = None
+        training_dictionary = None
+
+        if patching:
+            rows = database.execute('''
+                SELECT value FROM metadata WHERE key = "training_dictionary"
+            ''').fetchall()
+
+            if len(rows) > 0:
+                training_dictionary = json.loads(rows[0][0])
+
+            rows = database.execute('''
+                SELECT value FROM metadata WHERE key = "dictionary"
+            ''').fetchall()
+
+            if len(rows) > 0:
+                metadata_dictionary_previous = rows[0][0]
+
+                location, data = database.execute('''
+                    SELECT location, data FROM encodings
+                    WHERE uri = ? AND encoding = ""
+                ''', (json.loads(rows[0][0])["uri"],)).fetchone()
+
+                dictionary_previous = data \
+                    if location == "DATABASE" \
+                    else data_file(path_previous + "/" + data)
+
+        shutil.copy(PATH_ROUTER, path_release + "/main.php")
+
+        lock_database = threading.Lock()
+        count_transaction = 0
+
+        ## Executes the given statement on the database and returns its rows.
+        ## Statements are batched into transactions, so that streaming them to
+        ## disk doesn't cost a sync each.
+        def execute(statement, parameters=()):
+            nonlocal count_transaction
 
+            with lock_database:
+                if not database.in_transaction:
+                    database.execute("BEGIN")
+
+                rows = database.execute(statement, parameters).fetchall()
+
+                count_transaction += 1
+                if count_transaction >= SIZE_TRANSACTION_DATABASE:
+                    database.execute("COMMIT")
+                    count_transaction = 0
+
+                return rows
+
+        ## The URIs whose responses need working out again, since they were
+        ## inserted or their encodings changed in this build.
+        uris_negotiating = set()
+
+        ## Inserts the given URI with the given action and cache into the
+        ## database.
+        def insert_uri(uri, action, cache):
+            execute('''
+                INSERT INTO uris (uri, action, cache)
+                VALUES (?, ?, ?)
+            ''', (uri, action, cache))
+
+            with lock:
+                uris_negotiating.add(uri)
+
+        ## The dependency graph of this build. Each node is an asset (or a
+        ## graphic, which has no URI of its own) along with the input files it
+        ## was built from and the nodes it depends on.
+        graph_nodes = {}
+        graph_links = {}
+
+        nodes_previous = graph["nodes"] if patching else {}
+
+        matches = {}
+        cleans = {}
+
+        ## Returns whether the given node of the previous build is unaffected
+        ## by any changes since.
+        def is_clean(id):
+            if id not in cleans:
+                node = nodes_previous[id]
+
+                for path, stamp in node["inputs"].items():
+                    if path not in matches:
+                        matches[path] = matches_stamp(path, stamp)
+
+                cleans[id] = all(matches[path] for path in node["inputs"].keys()) \
+                    and all(
+                        child in nodes_previous and is_clean(child)
+                        for child in node["children"]
+                    )
 
+            return cleans[id]
+
+        links_clean = set()
+        uris_kept = set()
+        ids_kept = []
+        visited = set()
+
+        ## Keeps whatever is still up to date of the given node of the previous
+        ## build and the nodes it depends on. The node itself is never kept if
+        ## it is the root of a link that needs rebuilding.
+        def keep(id, root=False):
+            if id not in nodes_previous or id in visited:
+                return
+
+            visited.add(id)
+
+            node = nodes_previous[id]
+
+            if not root and is_clean(id):
+                graph_nodes[id] = node
+
+                if node["uri"] is not None:
+                    assets[id] = node["uri"]
+                    uris_kept.add(node["uri"])
+
+                ids_kept.append(id)
+
+            for child in node["children"]:
+                keep(child)
+
+        if patching:
+            for uri, link in links.items():
+                if uri not in graph["links"]:
+                    continue
+
+                link_previous = graph["links"][uri]
+
+                clean = link_previous["link"] == link \
+                    and all(
+                        matches_stamp(path, stamp)
+                        for path, stamp in link_previous["inputs"].items()
+                    ) \
+                    and (
+                        link_previous["node"] is None
+                        or (
+                            link_previous["node"] in nodes_previous
+                            and is_clean(link_previous["node"])
+                        )
+                    )
+
+                if clean:
+                    links_clean.add(uri)
+                    uris_kept.add(uri)
+
+                    graph_links[uri] = link_previous
+
+                if link_previous["node"] is not None:
+                    keep(link_previous["node"], not clean)
+
+            # Drop everything that needs rebuilding, which includes the past
+            # URIs of assets since those get recomputed anyway.
+            uris_dropped = []
+            for (uri,) in execute("SELECT uri FROM uris"):
+                if uri not in uris_kept:
+                    uris_dropped.append((uri,))
+
+            for table in ["negotiations", "encodings", "resources", "redirects", "uris"]:
+                for parameters in uris_dropped:
+                    execute("DELETE FROM " + table + " WHERE uri = ?", parameters)
+
+        ## The types of the assets in the database, by URI. Assets are addressed
+        ## by their content, so identical assets at different paths share one
+        ## URI and are only inserted once.
+        types_assets = {}
+
+        for uri, type in execute("SELECT uri, type FROM resources"):
+            if uri.startswith("/" + PREFIX_URI_ASSET):
+                types_assets[uri] = type
+
+        ## The text resources inserted in this build, to encode with the shared
+        ## dictionary once it is known.
+        resources_text = []
+
+        ## The resource files written to the release so far.
+        paths_written = set()
+
+        threshold = threshold_encoding()
+
+        ## Inserts the given encoding of the resource with the given URI and ID
+        ## into the database.
+        def insert_encoding(uri, id, data_encoding, encoding):
+            time_insert = time.perf_counter()
+
+            location = "DATABASE"
+            length_data = len(data_encoding)
+
+            # Decide location for the file.
+            if length_data > threshold:
+                # Data is too big to be efficiently handled by the database;
+                # put it in the filesystem instead.
+
+                # Files are named after their content, so that identical
+                # encodings share a single file. Oh you, Windows...
+                filename = base64.b32encode(
+                    hash(data_encoding)[:LENGTH_ID_ASSET]
+                ).decode("UTF-8").replace("=", "")
+                path = PATH_RESOURCES + "/" + filename
+
+                with lock:
+                    written = path in paths_written
+                    paths_written.add(path)
+
+                if not written:
+                    # An unchanged file of the previous release can simply be
+                    # linked to.
+                    if path_previous is not None \
+                    and os.path.exists(path_previous + "/" + path):
+                        link_file(path_previous + "/" + path, path_release + "/" + path)
+                    else:
+                        file = open(path_release + "/" + path, "wb")
+                        file.write(data_encoding)
+                        file.close()
+
+                location = "FILESYSTEM"
+                data_encoding = path
+
+            execute('''
+                INSERT INTO encodings (
+                    uri,
+                    encoding,
+                    location,
+                    data,
+                    length
+                )
+                VALUES (?, ?, ?, ?, ?)
+            ''', (uri, encoding, location, data_encoding, length_data))
+
+            with lock:
+                uris_negotiating.add(uri)
+
+            record_span("insert", time_insert, {"asset": uri, "encoding": encoding})
+
+        ## Returns the ID of the resource with the given data and URI.
+        def id_resource(data, uri):
+            return hash(data + uri.encode("UTF-8"))[:LENGTH_ID_ASSET]
+
+        ## Inserts a resource into the database.
+        def insert_resource(data, type, cache, uri="", encoded=True):
+            id = id_resource(data, uri)
+
+            if uri == "":
+                uri = "/" + PREFIX_URI_ASSET + base64.urlsafe_b64encode(id).decode("UTF-8").replace("=", "")
+                etag = "\"\""
+
+                # TODO I'm not sure I want to make this a hard requirement
+                assert cache == "INDEFINITE"
+
+                # An identical asset is in already, or on its way.
+                with lock:
+                    if uri in types_assets:
+                        if types_assets[uri] != type:
+                            raise RuntimeError("Identical assets of different types: " + uri)
+
+                        return uri
+
+                    types_assets[uri] = type
+            else:
+                etag = "\"" + base64.b85encode(id).decode("UTF-8") + "\""
+
+            if zstandard is not None and type.startswith(TYPES_DICTIONARY):
+                with lock:
+                    resources_text.append((uri, data))
+
+            insert_uri(uri, "RESOURCE", cache)
+
+            execute('''
+                INSERT INTO resources (
+                    uri,
+                    type,
+                    etag
+                )
+                VALUES (?, ?, ?)
+            ''', (uri, type, etag))
+
+            ## Encodes the data with the given encoding, pulling from the
+            ## build cache if possible.
+            def run(encoding):
+                key = key_cache("encode", hash_data, {
+                    "encoding": encoding,
+                    "encoders": list(ENCODERS_ENCODING[encoding].keys()),
+                })
+
+                data_encoding = read_cache(key)
+                if data_encoding is None:
+                    data_encoding = scheduler.ptask(
+                        encode,
+                        (data, encoding),
+                        len(data),
+                        details={"asset": uri, "encoding": encoding}
+                    ).wait()
+
+                    write_cache(key, data_encoding)
+
+                return data_encoding
+
+            hash_data = hash(data)
+
+            tasks = []
+
+            if encoded:
+                for encoding in ENCODERS_ENCODING.keys():
+                    tasks.append((scheduler.ntask(run, (encoding,), name="encode"), encoding))
+            
+            insert_encoding(uri, id, data, "")
+
+            for task, encoding in tasks:
+                data_encoding = task.wait()
+
+                # No point if the compressed data is bigger than the original.
+                if len(data_encoding) < len(data):
+                    insert_encoding(uri, id, data_encoding, encoding)
+
+            return uri
+
+        ids_inserting = set()
+
+        ## Inserts an asset into the database.
+        def insert_asset(id, data, type, cache, uri="", encoded=True):
+            with lock:
+                if id in assets or id in ids_inserting:
+                    raise RuntimeError("Duplicate id: " + id)
+
+                ids_inserting.add(id)
+            
+            uri = insert_resource(data, type, cache, uri, encoded)
+
+            with lock:
+                ids_inserting.remove(id)
+
+                assets[id] = uri
+
+                # Track the URI's history.
+                history_assets[uri] = id
+        
+            return uri
         
+        tasks_renders = {}
+
+        ## Inserts the given image as a series of graphic assets into the
+        ## database.
+        def insert_graphic(path, quality):
+            id = id_path(path)
+            id_graphic = id + ";" + quality
+
+            data = data_file(path)
+            hash_data = hash(data)
+            stamp = stamp_file(path, hash_data)
+
+            formats = []
+
+            for type, qualities in QUALITIES_GRAPHIC.items():
+                if quality in qualities:
+                    formats.append((type, quality))
+                # Very high quality is not supported by all lossy formats; use
+                # high quality instead.
+                elif quality == "VERY HIGH" and "HIGH" in qualities:
+                    formats.append((type, "HIGH"))
+
+            # Only the header is read here; the pixels are decoded once, later,
+            # if anything actually needs to be rendered.
+            with PIL.Image.open(io.BytesIO(data)) as image:
+                widths = widths_graphic(image.width)
+
+            lock_source = threading.Lock()
+            sources = []
+
+            ## Returns the description of the shared decoded image, decoding it
+            ## the first time around.
+            def source():
+                with lock_source:
+                    if len(sources) == 0:
+                        with span("decode", {"asset": id_graphic}):
+                            sources.append(share_image(data))
+
+                    return sources[0][1]
+
+            tasks = []
+            assets_graphic = {}
+            specifications = []
+
+            ## Returns the key of the render with the given asset ID. Renders
+            ## go by the image rather than its path, so that identical images
+            ## at different paths share theirs.
+            def key_render(id_asset):
+                return hash_data.hex() + id_asset[len(id):]
+
+            with lock:
+                for type, quality in formats:
+                    for width in widths:
+                        id_asset = id + ";" + type + ";" + str(width) + ";" + quality
+
+                        if key_render(id_asset) in tasks_renders:
+                            task = tasks_renders[key_render(id_asset)]
+                        # Kept from the previous build.
+                        elif id_asset in assets:
+                            def run(id_asset):
+                                return (assets[id_asset], graph_nodes[id_asset]["length"])
+
+                            task = scheduler.ntask(run, (id_asset,), name="keep")
+                        else:
+                            # Filled in once the render task exists.
+                            task = None
+
+                            specifications.append((type, quality, width, id_asset))
+
+                        tasks.append([task, id_asset, type, width])
+
+                ## Losslessly recompresses the given PNG render, pulling from
+                ## the build cache if possible.
+                def optimize(data_conversion):
+                    key = key_cache("optimize", data_conversion, {
+                        "encoders": VERSIONS_ENCODER_GRAPHIC,
+                    })
+
+                    data_optimized = read_cache(key)
+                    if data_optimized is None:
+                        data_optimized = scheduler.ptask(
+                            optimize_png,
+                            (data_conversion,),
+                            len(data_conversion),
+                            details={"asset": id_graphic}
+                        ).wait()
+
+                        write_cache(key, data_optimized)
+
+                    return data_optimized
+
+                ## Renders the given specifications, pulling from the build
+                ## cache where possible. Returns the renders by asset ID.
+                def render(specifications):
+                    datas = {}
+                    misses = []
+
+                    for type, quality, width, id_asset in specifications:
+                        settings = {
+                            "type": type,
+                            "width": width,
+                            "quality": quality,
+                            "definition": QUALITIES_GRAPHIC[type][quality],
+                            "target": target_render(type, quality),
+                            "pyramid": GAP_PYRAMID_GRAPHIC,
+                            "optimizing": OPTIMIZING_GRAPHIC,
+                            "encoders": VERSIONS_ENCODER_GRAPHIC,
+                        }
+
+                        key = key_cache("render", hash_data, settings)
+
+                        data_conversion = read_cache(key)
+                        if data_conversion is not None:
+                            datas[id_asset] = data_conversion
+
+                            continue
+
+                        # A searched for encoder quality setting outlives the
+                        # render it was found with, so it is cached by itself.
+                        key_search = None
+                        value_quality = None
+
+                        if settings["target"] is not None:
+                            key_search = key_cache("search", hash_data, settings)
+
+                            data_search = read_cache(key_search)
+                            if data_search is not None:
+                                value_quality = json.loads(data_search)
+
+                        misses.append((type, quality, width, value_quality, id_asset, key, key_search))
+
+                    if len(misses) > 0:
+                        # Get the biggest renders going first.
+                        renders = scheduler.ptask(
+                            render_images,
+                            (source(), [miss[:4] for miss in misses]),
+                            sum(miss[2] * miss[2] for miss in misses),
+                            details={"asset": id_graphic, "count": len(misses)}
+                        ).wait()
+
+                        for miss, (data_conversion, value_quality) in zip(misses, renders):
+                            _, _, _, _, id_asset, key, key_search = miss
+
+                            write_cache(key, data_conversion)
+                            if key_search is not None:
+                                write_cache(key_search, json.dumps(value_quality).encode("UTF-8"))
+
+                            datas[id_asset] = data_conversion
+
+                    if OPTIMIZING_GRAPHIC:
+                        tasks_optimize = []
+
+                        for type, _, _, id_asset in specifications:
+                            if type == "image/png":
+                                tasks_optimize.append((
+                                    id_asset,
+                                    scheduler.ntask(optimize, (datas[id_asset],))
+                                ))
+
+                        for id_asset, task in tasks_optimize:
+                            datas[id_asset] = task.wait()
+
+                    return datas
+
+                ## Inserts the rendered image as an asset.
+                def run(id_asset, type, task_render):
+                    data_conversion = task_render.wait()[id_asset]
+
+                    # TODO perhaps we may want to encode images? Probably worth
+                    # attempting only for PNGs and JPEGs.
+                    uri_asset = insert_asset(
+                        id_asset,
+                        data_conversion,
+                        type,
+                        "INDEFINITE",
+                        "",
+                        False
+                    )
+
+                    graph_nodes[id_asset] = {
+                        "uri": uri_asset,
+                        "inputs": {id: stamp},
+                        "children": [],
+                        "length": len(data_conversion),
+                    }
+
+                    return (uri_asset, len(data_conversion))
+
+                if len(specifications) > 0:
+                    # All widths of every type in one go, so that each width is
+                    # only ever resized to once.
+                    task_render = scheduler.ntask(render, (specifications,), name="render")
+
+                    for entry in tasks:
+                        if entry[0] is None:
+                            entry[0] = scheduler.ntask(
+                                run,
+                                (entry[1], entry[2], task_render),
+                                dependencies=[task_render],
+                                name="insert_render"
+                            )
+
+                            tasks_renders[key_render(entry[1])] = entry[0]
+
+            try:
+                for task, id_asset, type, width in tasks:
+                    if type not in assets_graphic:
+                        assets_graphic[type] = {}
+                    
+                    assets_graphic[type][width] = task.wait()
+
+                    # Rendered for an identical image at another path; this
+                    # path's asset points to the same one.
+                    with lock:
+                        if id_asset not in assets:
+                            uri_asset, length = assets_graphic[type][width]
+
+                            assets[id_asset] = uri_asset
+                            graph_nodes[id_asset] = {
+                                "uri": uri_asset,
+                                "inputs": {id: stamp},
+                                "children": [],
+                                "length": length,
+                            }
+            finally:
+                # Every render of this graphic is done with the source by now.
+                for memory, _ in sources:
+                    memory.close()
+                    memory.unlink()
+
+            graph_nodes[id_graphic] = {
+                "uri": None,
+                "inputs": {id: stamp},
+                "children": [id_asset for _, id_asset, _, _ in tasks],
+            }
+
+            return assets_graphic
+
+        ## Runs the given document stage with the given arguments, the first of
+        ## which is the document of the asset with the given ID. Big documents
+        ## go to the pool so they don't hold up the threads; small ones aren't
+        ## worth the trip.
+        def run_document(function, arguments, id):
+            if len(arguments[0]) > LENGTH_PARALLEL_DOCUMENT:
+                return scheduler.ptask(
+                    function,
+                    arguments,
+                    len(arguments[0]),
+                    details={"asset": id}
+                ).wait()
+
+            with span(function.__name__, {"asset": id}):
+                return function(*arguments)
+
+        ## Minifies the data of the asset with the given ID and type. Returns
+        ## the minified data and its type.
+        def minify_asset(id, data, type):
+            key_minify = key_cache("minify", data, {"type": type})
+
+            data_minified = read_cache(key_minify)
+            if data_minified is None:
+                data_minified = run_document(minify, (data, type), id)
+
+                write_cache(key_minify, data_minified)
+
+            return data_minified, type_minified(type)
+
+        tasks_files = {}
+
+        ## Inserts a file as an asset into the database, only once no matter
+        ## how many documents depend on it at the same time.
+        def insert_file(path, type, cache, uri=""):
+            id = id_path(path)
+
+            with lock:
+                if id in assets:
+                    uri_file = assets[id]
+                    task = None
+                else:
+                    if id not in tasks_files:
+                        tasks_files[id] = scheduler.ntask(
+                            build_file,
+                            (id, path, type, cache, uri)
+                        )
 
+                    task = tasks_files[id]
 
+            if task is not None:
+                uri_file = task.wait()
 
+            if uri != "" and uri != uri_file:
+                raise RuntimeError("Duplicate URIs for asset")
 
+            return uri_file
+
+        ## Builds the file with the given ID as an asset into the database. Use
+        ## `insert_file` instead.
+        def build_file(id, path, type, cache, uri):
+            # TODO is this something I'm willing to commit to?
+            assert type != ""
+
+            # TODO parse charset?
+
+            data = data_file(path)
+            stamp = stamp_file(path, hash(data))
+
+            children = []
+
+            match type:
+                # HTML.
+                case "application/msssg+xml;charset=UTF-8":
+                    directory = os.path.dirname(path)
+
+                    key_scan = key_cache("scan", data)
+
+                    scan = read_cache(key_scan)
+                    if scan is None:
+                        scan = run_document(scan_document, (data,), id)
+
+                        write_cache(key_scan, json.dumps(scan).encode("UTF-8"))
+                    else:
+                        scan = json.loads(scan)
+
+                    tasks_assets = []
+                    paths_stylesheets = []
+
+                    for path_subasset, type_subasset in scan["assets"]:
+                        path_subasset = directory + "/" + path_subasset
+
+                        paths_stylesheets.append(
+                            path_subasset if type_subasset.startswith("text/css") else None
+                        )
+
+                        tasks_assets.append(scheduler.ntask(
+                            insert_file,
+                            (path_subasset, type_subasset, "INDEFINITE")
+                        ))
+
+                        children.append(id_path(path_subasset))
+
+                    tasks_graphics = []
+
+                    for path_graphic, quality in scan["graphics"]:
+                        path_graphic = directory + "/" + path_graphic
+
+                        tasks_graphics.append(scheduler.ntask(
+                            insert_graphic,
+                            (path_graphic, quality)
+                        ))
+
+                        children.append(id_path(path_graphic) + ";" + quality)
+
+                    with span("resolve", {"asset": id}, "wait"):
+                        uris_assets = [task.wait() for task in tasks_assets]
+                        assets_graphics = [task.wait() for task in tasks_graphics]
+
+                    # The transformed document only depends on the source
+                    # document and what its dependencies resolved to.
+                    key_transform = key_cache("transform", data, {
+                        "assets": uris_assets,
+                        "graphics": assets_graphics,
+                        "fallback": WIDTH_FALLBACK_GRAPHIC,
+                    })
+
+                    data_document = read_cache(key_transform)
+                    if data_document is None:
+                        data_document = run_document(
+                            transform_document,
+                            (data, uris_assets, assets_graphics),
+                            id
+                        )
+
+                        write_cache(key_transform, data_document)
+
+                    if INLINING_STYLESHEETS \
+                    and any(path_stylesheet is not None for path_stylesheet in paths_stylesheets):
+                        stylesheets = {
+                            uri_subasset: data_file(path_stylesheet)
+                            for uri_subasset, path_stylesheet in zip(uris_assets, paths_stylesheets)
+                            if path_stylesheet is not None
+                        }
+
+                        key_inline = key_cache("inline", data_document, {
+                            "stylesheets": {
+                                uri_subasset: hash(stylesheet).hex()
+                                for uri_subasset, stylesheet in stylesheets.items()
+                            },
+                            "length": LENGTH_INLINE_STYLESHEET,
+                        })
+
+                        data_inlined = read_cache(key_inline)
+                        if data_inlined is None:
+                            data_inlined = run_document(
+                                inline_stylesheets,
+                                (data_document, stylesheets),
+                                id
+                            )
+
+                            write_cache(key_inline, data_inlined)
+
+                        data_document = data_inlined
+
+                    data = data_document
+
+                    type = "application/xhtml+xml;charset=UTF-8"
+
+            # The lengths before and after minifying are kept on the node, so
+            # that they carry over to builds that don't rebuild the asset.
+            lengths_minify = None
+
+            if MINIFYING_OUTPUT and type.startswith(TYPES_MINIFY):
+                length_before = len(data)
+                data, type = minify_asset(id, data, type)
+                lengths_minify = [length_before, len(data)]
+
+            uri = insert_asset(id, data, type, cache, uri)
+
+            graph_nodes[id] = {
+                "uri": uri,
+                "inputs": {id: stamp},
+                "children": children,
+            }
+
+            if lengths_minify is not None:
+                graph_nodes[id]["minify"] = lengths_minify
+
+            return uri
+
+        record_span("setup", time_phase)
+        time_phase = time.perf_counter()
+
+        ## Inserts the permalink with the given URI and link into the
+        ## database.
+        def insert_permalink(uri, link):
+            data = data_file(link["path"])
+
+            insert_resource(data, link["type"], link["cache"], uri)
+
+            graph_links[uri]["inputs"][link["path"]] = stamp_file(link["path"], hash(data))
+
+        # Every link is built at the same time.
         tasks = []
 
         for uri, link in links.items():
@@ -906,12 +2905,27 @@ def main():
             if uri in history_assets:
                 del history_assets[uri]
 
+            # Nothing changed since the previous build.
+            if uri in links_clean:
+                continue
+
+            graph_links[uri] = {
+                "link": link,
+                "node": None,
+                "inputs": {},
+            }
+
             match link["action"]:
                 # Serve a resource to the client.
                 case "RESOURCE":
                     cache = "NONE" if not "cache" in link else link["cache"]
 
-                    insert_file(link["path"], link["type"], cache, uri)
+                    tasks.append(scheduler.ntask(
+                        insert_file,
+                        (link["path"], link["type"], cache, uri)
+                    ))
+
+                    graph_links[uri]["node"] = id_path(link["path"])
                 
                 # Serve a permanent URI to a resource to the client.
                 case "PERMALINK":
@@ -919,17 +2933,17 @@ def main():
 
                     if cache == "INDEFINITE":
                         raise RuntimeError("Illegal cache for permalink: INDEFINITE")
-                    
-                    insert_resource(data_file(link["path"]), link["type"], cache, uri)
+
+                    tasks.append(scheduler.ntask(
+                        insert_permalink,
+                        (uri, dict(link, cache=cache))
+                    ))
 
                 # Tell the client to redirect.
                 case "REDIRECT":
-                    database.execute('''
-                        INSERT INTO uris (uri, action, cache)
-                        VALUES (?, "REDIRECT", ?)
-                    ''', (uri, link["cache"]))
+                    insert_uri(uri, "REDIRECT", link["cache"])
 
-                    database.execute('''
+                    execute('''
                         INSERT INTO redirects (uri, type, location)
                         VALUES (?, ?, ?)
                     ''', (uri, link["type"], link["location"]))
@@ -940,9 +2954,186 @@ def main():
         for task in tasks:
             task.wait()
 
+        record_span("links", time_phase)
+        time_phase = time.perf_counter()
+
+        # Text resources share a lot of boilerplate, which clients holding the
+        # shared dictionary don't need sent over and over again.
+        dictionary = None
+
+        if zstandard is not None:
+            # In a fixed order, since links are built in any order, so that
+            # the dictionary comes out the same every time.
+            resources_text.sort()
+
+            length_changed = sum(len(data) for _, data in resources_text)
+
+            # Only resources inserted in this build changed since the previous
+            # one, which is all of them without patching.
+            if training_dictionary is not None:
+                training_dictionary["changed"] += length_changed
+
+            if training_dictionary is not None \
+            and training_dictionary["changed"] <= SHARE_RETRAIN_DICTIONARY * training_dictionary["length"]:
+                dictionary = dictionary_previous
+            else:
+                # Kept resources are needed to train on as well.
+                resources_training = resources_text
+
+                if patching:
+                    ## Returns the data of the encoding with the given location
+                    ## and data.
+                    def data_encoding(location, data):
+                        if location == "DATABASE":
+                            return data
+
+                        # Kept files are only linked over at the very end.
+                        if os.path.exists(path_release + "/" + data):
+                            return data_file(path_release + "/" + data)
+                        else:
+                            return data_file(path_previous + "/" + data)
+
+                    resources_training = []
+                    for uri, type, location, data in execute('''
+                        SELECT resources.uri, type, location, data
+                        FROM resources JOIN encodings ON resources.uri = encodings.uri
+                        WHERE encoding = ""
+                        ORDER BY resources.uri
+                    '''):
+                        if type.startswith(TYPES_DICTIONARY):
+                            resources_training.append((uri, data_encoding(location, data)))
+
+                training_dictionary = {
+                    "length": sum(len(data) for _, data in resources_training),
+                    "changed": 0,
+                }
+
+                if len(resources_training) > 0:
+                    samples = [data for _, data in resources_training]
+
+                    key = key_cache("dictionary", b"".join(map(hash, samples)), {
+                        "size": SIZE_DICTIONARY,
+                    })
+
+                    dictionary = read_cache(key)
+                    if dictionary is None:
+                        dictionary = scheduler.ptask(
+                            train_dictionary,
+                            (samples,),
+                            details={"count": len(samples)}
+                        ).wait()
+
+                        # Not enough to go on; don't try again next time either.
+                        write_cache(key, dictionary if dictionary is not None else b"")
+
+                    if dictionary == b"":
+                        dictionary = None
+
+                # Everything was encoded with the previous dictionary, which
+                # is gone now. Their responses are all worked out again anyway,
+                # see below.
+                if dictionary != dictionary_previous:
+                    execute('''
+                        DELETE FROM encodings WHERE encoding = "dcz"
+                    ''')
+
+                    resources_text = resources_training
+
+            execute('''
+                INSERT OR REPLACE INTO metadata (key, value)
+                VALUES ("training_dictionary", ?)
+            ''', (json.dumps(training_dictionary),))
+
+        if dictionary is not None:
+            uri_dictionary = insert_asset(
+                "~dictionary",
+                dictionary,
+                "application/octet-stream",
+                "INDEFINITE"
+            )
+            hash_dictionary = hash(dictionary)
+
+            ## Encodes the resource with the given URI and data with the
+            ## dictionary, pulling from the build cache if possible.
+            def run(uri, data):
+                key = key_cache("encode", hash(data), {
+                    "encoding": "dcz",
+                    "dictionary": hash_dictionary.hex(),
+                })
+
+                data_encoding = read_cache(key)
+                if data_encoding is None:
+                    data_encoding = scheduler.ptask(
+                        encode_dictionary,
+                        (data, dictionary),
+                        len(data),
+                        details={"asset": uri}
+                    ).wait()
+
+                    write_cache(key, data_encoding)
+
+                # No point if the compressed data is bigger than the original.
+                if len(data_encoding) < len(data):
+                    insert_encoding(uri, id_resource(data, uri), data_encoding, "dcz")
+
+            # Resources kept by patching are encoded already, unless the
+            # dictionary was trained again.
+            tasks = []
+            for uri, data in resources_text:
+                tasks.append(scheduler.ntask(run, (uri, data), name="encode_dictionary"))
+
+            for task in tasks:
+                task.wait()
+
+        scheduler.close()
+
         pool.close()
         pool.join()
 
+        record_span("dictionary", time_phase)
+        time_phase = time.perf_counter()
+
+        ## Collects the given node and every node it depends on.
+        def collect(id, ids):
+            if id in ids:
+                return
+
+            ids.add(id)
+
+            for child in graph_nodes[id]["children"]:
+                collect(child, ids)
+
+        ids_live = set()
+        for link in graph_links.values():
+            if link["node"] is not None:
+                collect(link["node"], ids_live)
+
+        # Identical assets share their URI, so a URI lives on for as long as
+        # any asset holding it does.
+        uris_live = set()
+        for id in ids_live:
+            if graph_nodes[id]["uri"] is not None:
+                uris_live.add(graph_nodes[id]["uri"])
+
+        # Kept assets that nothing depends on anymore are gone for good, along
+        # with their URIs unless another asset still holds them. Resource files
+        # go once no encoding is stored in them anymore, see below.
+        for id in ids_kept:
+            if id not in ids_live:
+                uri_asset = graph_nodes.pop(id)["uri"]
+
+                if uri_asset is not None and uri_asset not in uris_live:
+                    del assets[id]
+
+                    for table in ["negotiations", "encodings", "resources", "redirects", "uris"]:
+                        execute(
+                            "DELETE FROM " + table + " WHERE uri = ?",
+                            (uri_asset,)
+                        )
+            # Kept assets weren't reinserted; track their URIs' history still.
+            elif graph_nodes[id]["uri"] is not None:
+                history_assets[graph_nodes[id]["uri"]] = id
+
         for uri, id_asset in history_assets.items():
             # The asset is alive and well; redirect past URIs.
             if id_asset in assets:
@@ -950,30 +3141,225 @@ def main():
 
                 # Only redirect *past* URIs.
                 if uri != uri_asset:
-                    database.execute('''
-                        INSERT INTO uris (uri, action, cache)
-                        VALUES (?, "REDIRECT", "NONE")
-                    ''', (uri,))
+                    insert_uri(uri, "REDIRECT", "NONE")
                     
-                    database.execute('''
+                    execute('''
                         INSERT INTO redirects (uri, type, location)
                         VALUES (?, ?, ?)
                     ''', (uri, "PERMANENT", uri_asset))
 
             # The asset has been deleted; send `Gone` to client.
             else:
-                database.execute('''
-                    INSERT INTO uris (uri, action, cache)
-                    VALUES (?, "DELETION", "NONE")
-                ''', (uri,))
+                insert_uri(uri, "DELETION", "NONE")
+
+        record_span("history", time_phase)
+        time_phase = time.perf_counter()
+
+        # Clients only get `dcz` if they hold the dictionary, which they tell
+        # by its hash.
+        metadata_dictionary = None
+
+        if dictionary is not None:
+            hash_available_dictionary = ":" + base64.b64encode(
+                hashlib.sha256(dictionary).digest()
+            ).decode("UTF-8") + ":"
+
+            metadata_dictionary = json.dumps({
+                "uri": uri_dictionary,
+                "hash": hash_available_dictionary,
+            })
+
+            execute('''
+                INSERT OR REPLACE INTO metadata (key, value)
+                VALUES ("dictionary", ?)
+            ''', (metadata_dictionary,))
+        else:
+            execute('''
+                DELETE FROM metadata WHERE key = "dictionary"
+            ''')
+
+        execute('''
+            INSERT OR REPLACE INTO metadata (key, value)
+            VALUES ("threshold", ?)
+        ''', (json.dumps(threshold),))
+
+        # The dictionary is named in the headers of every text resource.
+        if metadata_dictionary != metadata_dictionary_previous:
+            for (uri,) in execute("SELECT uri FROM uris"):
+                uris_negotiating.add(uri)
+
+        # Precompute the responses to the URIs that changed, one for each
+        # encoding the URI has, the smallest first, so that serving is a
+        # single lookup of the first one the client accepts.
+        for uri in sorted(uris_negotiating):
+            execute('''
+                DELETE FROM negotiations WHERE uri = ?
+            ''', (uri,))
+
+            rows = execute('''
+                SELECT
+                    action,
+                    cache,
+                    resources.type,
+                    etag,
+                    redirects.type,
+                    redirects.location
+                FROM
+                    uris
+                    LEFT JOIN resources ON uris.uri = resources.uri
+                    LEFT JOIN redirects ON uris.uri = redirects.uri
+                WHERE uris.uri = ?
+            ''', (uri,))
+
+            # Gone for good.
+            if len(rows) == 0:
+                continue
+
+            action, cache, type, etag, type_redirect, location = rows[0]
+
+            lengths = dict(execute('''
+                SELECT encoding, length FROM encodings WHERE uri = ?
+            ''', (uri,)))
+
+            headers = []
+
+            if HEADERS_CACHE[cache] is not None:
+                headers.append("Cache-Control: " + HEADERS_CACHE[cache])
+
+            # Not a resource; there's only the one response.
+            encodings = [None]
+
+            match action:
+                case "RESOURCE":
+                    status = 404 if uri == "~notfound" else 200
+
+                    if HEADERS_CACHE[cache] is not None:
+                        if "dcz" in lengths:
+                            headers.append("Vary: Accept-Encoding, Available-Dictionary")
+                        else:
+                            headers.append("Vary: Accept-Encoding")
+
+                        # Never send an etag with a 404.
+                        if uri != "~notfound":
+                            headers.append("ETag: " + etag)
+
+                    if dictionary is not None:
+                        if uri == uri_dictionary:
+                            headers.append("Use-As-Dictionary: match=\"/*\"")
+                        elif type.startswith(TYPES_DICTIONARY):
+                            headers.append("Link: <" + uri_dictionary + ">; rel=\"compression-dictionary\"")
+
+                    encodings = sorted(
+                        [
+                            encoding for encoding in lengths.keys()
+                            if encoding != "dcz" or dictionary is not None
+                        ],
+                        key=lambda encoding: (lengths[encoding], encoding)
+                    )
+
+                case "REDIRECT":
+                    status = 301 if type_redirect == "PERMANENT" else 302
+
+                    headers.append("Location: " + location)
+
+                case "DELETION":
+                    status = 410
+
+            for rank, encoding in enumerate(encodings):
+                headers_content = None
+
+                if encoding is not None:
+                    headers_content = ["Content-Type: " + type]
+                    if encoding != "":
+                        headers_content.append("Content-Encoding: " + encoding)
+                    headers_content.append("Content-Length: " + str(lengths[encoding]))
+
+                    headers_content = "\n".join(headers_content)
+
+                execute('''
+                    INSERT INTO negotiations (
+                        uri,
+                        rank,
+                        encoding,
+                        dictionary,
+                        status,
+                        headers,
+                        headers_content,
+                        etag
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    uri,
+                    rank,
+                    encoding,
+                    hash_available_dictionary if encoding == "dcz" else None,
+                    status,
+                    "\n".join(headers),
+                    headers_content,
+                    etag
+                ))
+
+        if database.in_transaction:
+            database.execute("COMMIT")
 
         database.execute('''
             PRAGMA optimize
         ''')
 
-        database.backup(database_disk, sleep=0)
-        database.close()
-        database_disk.close()
+        record_span("negotiations", time_phase)
+        time_phase = time.perf_counter()
+
+        paths_resources = set()
+        for (path_resource,) in database.execute('''
+            SELECT data FROM encodings WHERE location = "FILESYSTEM"
+        '''):
+            paths_resources.add(path_resource)
+
+        # Publish the database.
+        if STREAMING_DATABASE:
+            # Fold the log back into the database and leave WAL mode, so that
+            # the published database is a single self-contained file.
+            database.executescript('''
+                PRAGMA wal_checkpoint(TRUNCATE);
+                PRAGMA journal_mode = DELETE;
+            ''')
+            database.close()
+
+            os.replace(path_database_building, path_database)
+        else:
+            database_disk = sqlite3.connect(path_database_building)
+            with span("backup"):
+                database.backup(database_disk, sleep=0)
+            database_disk.close()
+            database.close()
+
+            os.replace(path_database_building, path_database)
+
+        for path_resource in paths_resources:
+            # Kept from the previous release.
+            if not os.path.exists(path_release + "/" + path_resource):
+                link_file(path_previous + "/" + path_resource, path_release + "/" + path_resource)
+
+        # Clean up files of encodings that were dropped. Identical encodings
+        # share their file, so it stays for as long as any of them does.
+        for filename in os.listdir(path_release + "/" + PATH_RESOURCES):
+            if PATH_RESOURCES + "/" + filename not in paths_resources:
+                os.remove(path_release + "/" + PATH_RESOURCES + "/" + filename)
+
+        path_replaced = publish_release(path_release)
+
+        # Keep the release just replaced around to roll back to, wherever it
+        # was moved, but nothing older than that.
+        paths_live = {os.path.realpath(PATH_SITE)}
+        if path_replaced is not None:
+            paths_live.add(os.path.realpath(path_replaced))
+        for name in os.listdir(PATH_RELEASES):
+            path = os.path.realpath(PATH_RELEASES + "/" + name)
+
+            if path not in paths_live:
+                shutil.rmtree(path)
+
+        record_span("publish", time_phase)
 
         json.dump(
             history_assets,
@@ -982,17 +3368,69 @@ def main():
             sort_keys=True
         )
         json.dump(
-            data_assets,
-            open("msssg/data_assets.json", "w"),
+            {
+                "settings": fingerprint_settings(),
+                "links": graph_links,
+                "nodes": graph_nodes,
+            },
+            open("msssg/graph.json", "w"),
             indent=4,
             sort_keys=True
         )
 
+        # Report what minifying saved on every live asset, the most first.
+        lengths_minify = {
+            id: node["minify"]
+            for id, node in graph_nodes.items()
+            if "minify" in node
+        }
+
+        length_before_minify = sum(before for before, _ in lengths_minify.values())
+        length_after_minify = sum(after for _, after in lengths_minify.values())
+
+        json.dump(
+            {
+                "before": length_before_minify,
+                "after": length_after_minify,
+                "assets": [
+                    {
+                        "asset": id,
+                        "uri": graph_nodes[id]["uri"],
+                        "before": before,
+                        "after": after,
+                        "saved": before - after,
+                    }
+                    for id, (before, after) in sorted(
+                        lengths_minify.items(),
+                        key=lambda item: item[1][1] - item[1][0]
+                    )
+                ],
+            },
+            open(PATH_REPORT_MINIFY, "w"),
+            indent=4
+        )
+
         animator.terminate()
 
         duration = time.monotonic() - time_start
         print("\x1B[102;30m Build successful (" + "{:.3f}".format(duration) + " s) \x1B[0m")
 
+        if length_before_minify > 0:
+            print(
+                "Minifying saved " + str(length_before_minify - length_after_minify) + " B ("
+                + format(100 * (1 - length_after_minify / length_before_minify), ".1f")
+                + "%) on " + str(len(lengths_minify)) + " assets, see " + PATH_REPORT_MINIFY
+            )
+
+        if spans is not None:
+            ids_uris = {
+                node["uri"]: id
+                for id, node in graph_nodes.items()
+                if node["uri"] is not None
+            }
+
+            write_profile(spans, duration, ids_uris)
+
         sys.exit(0)
 
     except KeyboardInterrupt:
@@ -0,0 +1,262 @@
+import argparse
+import base64
+import http.client
+import json
+import random
+import server
+import sqlite3
+import statistics
+import threading
+import time
+
+## How often each kind of request comes up in the mix, relatively.
+WEIGHTS_MIX = {
+    "page": 35,
+    "graphic": 30,
+    "asset": 10,
+    "conditional": 15,
+    "redirect": 4,
+    "gone": 2,
+    "notfound": 4,
+}
+
+## The `Accept-Encoding` headers clients send, and how often they send them.
+## `None` leaves the header out altogether.
+WEIGHTS_ENCODING = {
+    "gzip, deflate, br, zstd": 50,
+    "gzip, deflate, br": 30,
+    "gzip, deflate": 10,
+    "gzip": 5,
+    None: 5,
+}
+
+## How often clients that accept `dcz` hold the site's dictionary already.
+RATE_DICTIONARY = 0.5
+
+## The percentiles of the latencies to report.
+PERCENTILES = [50, 90, 99]
+
+## Returns the requests of every kind the site in the given directory can be
+## sent, each a tuple of a URI and extra headers.
+def requests_site(path):
+    database = sqlite3.connect("file:" + path + "/database.db?mode=ro", uri=True)
+
+    requests = {kind: [] for kind in WEIGHTS_MIX.keys()}
+
+    for uri, action, type, etag in database.execute('''
+        SELECT uris.uri, action, type, etag
+        FROM uris LEFT JOIN resources ON uris.uri = resources.uri
+    '''):
+        if uri == "~notfound":
+            continue
+
+        match action:
+            case "RESOURCE":
+                if type.startswith("image/"):
+                    kind = "graphic"
+                elif type.startswith("application/xhtml+xml") or type.startswith("text/html"):
+                    kind = "page"
+                else:
+                    kind = "asset"
+
+                requests[kind].append((uri, {}))
+
+                # Assets have no etags to speak of; they never change anyway.
+                if etag != "\"\"":
+                    requests["conditional"].append((uri, {"If-None-Match": etag}))
+
+            case "REDIRECT":
+                requests["redirect"].append((uri, {}))
+
+            case "DELETION":
+                requests["gone"].append((uri, {}))
+
+    requests["notfound"] = [("/nonexistent/" + str(index), {}) for index in range(100)]
+
+    rows = database.execute('''
+        SELECT value FROM metadata WHERE key = "dictionary"
+    ''').fetchall()
+
+    hash_dictionary = json.loads(rows[0][0])["hash"] if len(rows) > 0 else None
+
+    database.close()
+
+    return requests, hash_dictionary
+
+## Returns the given number of requests mixed from the given requests of every
+## kind, each a tuple of its kind, URI and headers.
+def mix(requests, hash_dictionary, count, seed):
+    generator = random.Random(seed)
+
+    kinds = [kind for kind in WEIGHTS_MIX.keys() if len(requests[kind]) > 0]
+    weights = [WEIGHTS_MIX[kind] for kind in kinds]
+
+    encodings = list(WEIGHTS_ENCODING.keys())
+    weights_encoding = list(WEIGHTS_ENCODING.values())
+
+    authorization = "Basic " + base64.b64encode(server.CREDENTIALS.encode("UTF-8")).decode("UTF-8")
+
+    mixed = []
+
+    for _ in range(count):
+        kind = generator.choices(kinds, weights)[0]
+        uri, headers = generator.choice(requests[kind])
+
+        headers = dict(headers, Authorization=authorization)
+
+        encoding = generator.choices(encodings, weights_encoding)[0]
+        if encoding is not None:
+            # Clients that support zstd also support dictionaries, and send
+            # the dictionary they hold along.
+            if "zstd" in encoding and hash_dictionary is not None \
+            and generator.random() < RATE_DICTIONARY:
+                encoding += ", dcz"
+                headers["Available-Dictionary"] = hash_dictionary
+
+            headers["Accept-Encoding"] = encoding
+
+        mixed.append((kind, uri, headers))
+
+    return mixed
+
+## Returns the server-reported query duration of the given response in
+## seconds, or `None` if it didn't report one.
+def duration_query(response):
+    for metric in (response.getheader("Server-Timing") or "").split(","):
+        name, _, parameters = metric.strip().partition(";")
+
+        if name == "query" and parameters.startswith("dur="):
+            return float(parameters[len("dur="):]) / 1000
+
+    return None
+
+## Sends the requests of the given mix to the server at the given host and port
+## over a single kept-alive connection, taking turns with the other workers by
+## the given shared position. Adds the results to the given list.
+def work(host, port, mixed, position, lock, results):
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+
+    while True:
+        with lock:
+            index = position[0]
+            position[0] += 1
+
+        if index >= len(mixed):
+            break
+
+        kind, uri, headers = mixed[index]
+
+        time_start = time.perf_counter()
+
+        try:
+            connection.request("GET", uri, headers=headers)
+
+            response = connection.getresponse()
+            length = len(response.read())
+
+            results.append((
+                kind,
+                response.status,
+                time.perf_counter() - time_start,
+                duration_query(response),
+                length
+            ))
+
+        # Dropped connections count as errors; start a new one.
+        except (OSError, http.client.HTTPException):
+            results.append((kind, None, time.perf_counter() - time_start, None, 0))
+
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=30)
+
+    connection.close()
+
+## Returns the given percentile of the given sorted values.
+def percentile(values, percent):
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+## Formats the given latencies in seconds as percentiles in milliseconds.
+def format_latencies(latencies):
+    latencies = sorted(latencies)
+
+    return "  ".join(
+        ("p" + str(percent) + " " + format(percentile(latencies, percent) * 1000, ".2f")).rjust(12)
+        for percent in PERCENTILES
+    ) + ("max " + format(latencies[-1] * 1000, ".2f")).rjust(14)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replays a realistic mix of requests against a built site and reports how the server held up."
+    )
+    parser.add_argument("--host", default=server.ADDRESS[0])
+    parser.add_argument("--port", type=int, default=server.ADDRESS[1])
+    parser.add_argument("--site", default=server.PATH_SITE, help="the built site to take the requests from")
+    parser.add_argument("--concurrency", type=int, default=8, help="the number of connections to keep busy")
+    parser.add_argument("--requests", type=int, default=10000, help="the number of requests to send")
+    parser.add_argument("--seed", type=int, default=0)
+
+    arguments = parser.parse_args()
+
+    requests, hash_dictionary = requests_site(arguments.site)
+    mixed = mix(requests, hash_dictionary, arguments.requests, arguments.seed)
+
+    position = [0]
+    lock = threading.Lock()
+    results = []
+
+    threads = [
+        threading.Thread(
+            target=work,
+            args=(arguments.host, arguments.port, mixed, position, lock, results),
+            daemon=True
+        )
+        for _ in range(arguments.concurrency)
+    ]
+
+    time_start = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    duration = time.perf_counter() - time_start
+
+    statuses = {}
+    for _, status, _, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+
+    print(
+        str(len(results)) + " requests in " + format(duration, ".3f") + " s"
+        + " at a concurrency of " + str(arguments.concurrency)
+    )
+    print(
+        "Throughput " + format(len(results) / duration, ".1f") + " requests/s, "
+        + format(sum(result[4] for result in results) / duration / 1000000, ".2f") + " MB/s"
+    )
+    print("Statuses " + ", ".join(
+        ("error" if status is None else str(status)) + ": " + str(count)
+        for status, count in sorted(statuses.items(), key=lambda item: (item[0] is None, item[0]))
+    ))
+
+    print("Latency (ms)")
+    print("    " + "all".ljust(12) + format_latencies([result[2] for result in results]))
+
+    for kind in WEIGHTS_MIX.keys():
+        latencies = [result[2] for result in results if result[0] == kind]
+
+        if len(latencies) > 0:
+            print("    " + kind.ljust(12) + format_latencies(latencies))
+
+    queries = [result[3] for result in results if result[3] is not None]
+
+    if len(queries) > 0:
+        print("Server query time (ms)")
+        print("    " + "all".ljust(12) + format_latencies(queries))
+        print(
+            "    Query time is " + format(100 * sum(queries) / sum(result[2] for result in results), ".1f")
+            + "% of the latency, mean " + format(statistics.mean(queries) * 1000, ".3f") + " ms"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import builder
+import io
+import multiprocessing
+import numpy
+import os
+import PIL.Image
+import sys
+
+## The number of renders to compare against their reference at once. Bigger
+## batches vectorize better but cost a copy of the reference's pixels each.
+SIZE_BATCH = 8
+
+## The path of the produced rate-distortion table.
+PATH_OUTPUT = "research/output-rd.tsv"
+
+## Decoded source images, by path, so every process only decodes each once.
+images = {}
+
+## Renders the image at the path of the given job at the job's width at every
+## encoder quality setting of every searchable type, and measures each render.
+## Returns rows of the path, type, width, quality setting, length and SSIM.
+def sweep(job):
+    path, width = job
+
+    if path not in images:
+        images[path] = PIL.Image.open(path).convert(mode="RGB")
+
+    image = images[path]
+
+    height = round(width / (image.width / image.height))
+
+    if width == image.width:
+        image_resized = image
+    else:
+        image_resized = image.resize((width, height), PIL.Image.LANCZOS)
+
+    reference = numpy.asarray(image_resized)[numpy.newaxis]
+
+    rows = []
+
+    for type, (low, high) in builder.RANGES_QUALITY_GRAPHIC.items():
+        values = list(range(low, high + 1))
+
+        for index in range(0, len(values), SIZE_BATCH):
+            batch = values[index:index + SIZE_BATCH]
+            datas = []
+            renders = []
+
+            for value_quality in batch:
+                data = builder.encode_image(image_resized, type, None, value_quality)
+
+                with PIL.Image.open(io.BytesIO(data)) as image_render:
+                    renders.append(numpy.asarray(image_render.convert(mode="RGB")))
+
+                datas.append(data)
+
+            ssims = builder.ssim(reference, numpy.stack(renders))
+
+            for value_quality, data, ssim in zip(batch, datas, ssims):
+                rows.append((path, type, width, value_quality, len(data), float(ssim)))
+
+    if image_resized is not image:
+        image_resized.close()
+
+    return rows
+
+## Returns the lowest quality setting from which on every setting meets the given
+## target in the given rows, or `None` if not even the highest one does.
+def lowest_quality(rows, target):
+    value = None
+
+    for _, _, _, value_quality, _, ssim in sorted(rows, key=lambda row: -row[3]):
+        if ssim < target:
+            break
+
+        value = value_quality
+
+    return value
+
+def main():
+    paths = sys.argv[1:]
+
+    if len(paths) == 0:
+        print("Usage: research.py <image> [<image> ...]")
+
+        sys.exit(1)
+
+    jobs = []
+
+    for path in paths:
+        with PIL.Image.open(path) as image:
+            width_maximum = min(image.width, builder.WIDTH_MAXIMUM_GRAPHIC)
+
+        for width in range(builder.STEP_WIDTH_GRAPHIC, width_maximum + 1, builder.STEP_WIDTH_GRAPHIC):
+            jobs.append((path, width))
+
+    # Widest first, so that the stragglers are the quick ones.
+    jobs.sort(key=lambda job: -job[1])
+
+    rows = []
+
+    with multiprocessing.Pool(builder.COUNT_PROCESSES, initializer=builder.initializer) as pool:
+        for index, rows_job in enumerate(pool.imap_unordered(sweep, jobs)):
+            rows.extend(rows_job)
+
+            print("Swept " + str(index + 1) + "/" + str(len(jobs)) + "         ", end="\r")
+
+    print()
+
+    rows.sort(key=lambda row: row[:4])
+
+    os.makedirs(os.path.dirname(PATH_OUTPUT), exist_ok=True)
+
+    with open(PATH_OUTPUT, "w") as output:
+        output.write("image\ttype\twidth\tquality\tlength\tssim\n")
+
+        for row in rows:
+            output.write("\t".join(map(str, row)) + "\n")
+
+    print("Wrote " + PATH_OUTPUT)
+
+    # Regenerate the quality settings, taking the worst case over all images at
+    # the widths the current settings are defined at. Settings that weren't
+    # swept, like those of lossless renders, are kept as they are.
+    print("QUALITIES_GRAPHIC = {")
+
+    for type, qualities in builder.QUALITIES_GRAPHIC.items():
+        print("    \"" + type + "\": {")
+
+        for quality, definition in qualities.items():
+            target = builder.TARGETS_SSIM_GRAPHIC.get(quality)
+
+            if type not in builder.RANGES_QUALITY_GRAPHIC \
+            or target is None \
+            or not isinstance(definition, dict):
+                print("        \"" + quality + "\": " + repr(definition) + ",")
+                continue
+
+            print("        \"" + quality + "\": {")
+
+            for width in sorted(definition.keys()):
+                values = []
+
+                for path in paths:
+                    rows_width = [
+                        row for row in rows
+                        if row[0] == path and row[1] == type and row[2] == width
+                    ]
+
+                    # The image is too narrow to say anything about this width.
+                    if len(rows_width) == 0:
+                        continue
+
+                    value = lowest_quality(rows_width, target)
+
+                    values.append(builder.RANGES_QUALITY_GRAPHIC[type][1] if value is None else value)
+
+                # No image is wide enough, so keep the current setting.
+                if len(values) == 0:
+                    values.append(definition[width])
+
+                print("            " + str(width) + ": " + str(max(values)) + ",")
+
+            print("        },")
+
+        print("    },")
+
+    print("}")
+
+if __name__ == "__main__":
+    main()
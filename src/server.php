@@ -56,37 +56,44 @@ if (isset($_SERVER["HTTP_ACCEPT_ENCODING"])) {
         $encodings[$encoding] = null;
     }
 }
-$encodings = array_keys($encodings);
 
 $t = microtime(true);
 
+// Clients can only decode `dcz` if they hold the dictionary it was encoded with.
+$dictionary = isset($_SERVER["HTTP_AVAILABLE_DICTIONARY"])
+    ? trim($_SERVER["HTTP_AVAILABLE_DICTIONARY"])
+    : "";
+
+$encodings = array_keys($encodings);
+
+// The responses have been worked out by the builder ahead of time, one for each
+// encoding of the URI, the smallest first; look up the first one the client
+// accepts.
 $query = $database->prepare('
     SELECT
-        uris.uri AS uri,
-        uris.action AS action,
-        cache,
-        resources.type AS typeResource,
+        negotiations.uri AS uri,
+        status,
+        headers,
+        headers_content AS headersContent,
         etag,
-        encoding,
+        negotiations.encoding AS encoding,
         encodings.location AS locationData,
-        CASE WHEN etag = ? THEN NULL ELSE data END data,
-        length,
-        redirects.type AS typeRedirect,
-        redirects.location AS locationRedirect
+        CASE WHEN etag = ? THEN NULL ELSE data END data
     FROM
-        uris
-        LEFT JOIN resources ON uris.uri = resources.uri
-        LEFT JOIN encodings ON uris.uri = encodings.uri
-        LEFT JOIN redirects ON uris.uri = redirects.uri
+        negotiations
+        LEFT JOIN encodings
+            ON negotiations.uri = encodings.uri
+            AND negotiations.encoding = encodings.encoding
     WHERE
-        uris.uri IN (?, "~notfound")
+        negotiations.uri IN (?, "~notfound")
         AND (
-            encoding IN (' . implode(",", array_fill(0, sizeof($encodings), "?")) . ')
-            OR encoding IS NULL
+            negotiations.encoding IS NULL
+            OR negotiations.encoding IN (' . implode(",", array_fill(0, sizeof($encodings), "?")) . ')
         )
+        AND (dictionary IS NULL OR dictionary = ?)
     ORDER BY
-        uris.uri,
-        length
+        negotiations.uri,
+        rank
     LIMIT 1
 ');
 
@@ -95,6 +102,7 @@ $query->bindValue(2, $uri);
 foreach ($encodings as $index => $encoding) {
     $query->bindValue(3 + $index, $encoding);
 }
+$query->bindValue(3 + sizeof($encodings), $dictionary);
 
 $result = $query->execute();
 
@@ -113,106 +121,42 @@ header("Server-Timing: query;dur=" . number_format((microtime(true) - $t) * 1000
 
 assert($row !== false);
 
-if ($row["cache"] !== "NONE") {
-    switch ($row["cache"]) {
-        case "INSTANT":
-            header("Cache-Control: public, no-cache");
-            break;
-        
-        case "SHORT":
-            header("Cache-Control: public, max-age=100"); // 1.7 minutes.
-            break;
+foreach (explode("\n", $row["headers"]) as $header) {
+    if ($header !== "") {
+        header($header);
+    }
+}
+
+// Not a resource; there's nothing more to it than the status and headers.
+if (is_null($row["encoding"])) {
+    http_response_code($row["status"]);
+}
+// Client's cache was validated. 
+else if ($row["etag"] === $etag) {
+    // Since we never send etags with 404s, we will never accidentally send a
+    // 304 instead of a 404.
+    http_response_code(304);
+}
+// Serve the file.
+else {
+    http_response_code($row["status"]);
+
+    foreach (explode("\n", $row["headersContent"]) as $header) {
+        header($header);
+    }
 
-        case "MEDIUM":
-            header("Cache-Control: public, max-age=10000"); // 2.8 hours.
+    switch ($row["locationData"]) {
+        case "DATABASE":
+            echo $row["data"];
             break;
         
-        case "LONG":
-            header("Cache-Control: public, max-age=1000000"); // 11.6 days.
-            break;
-
-        case "INDEFINITE":
-            header("Cache-Control: public, max-age=31536000, immutable");
+        case "FILESYSTEM":
+            readfile($row["data"]);
             break;
         
         default:
-            throw new RuntimeException("Unknown cache: " . $row["cache"]);
+            throw new RuntimeException("Unknown resource location: " . $row["locationData"]);
     }
 }
 
-switch ($row["action"]) {
-    case "RESOURCE":
-        if ($row["cache"] !== "NONE") {
-            header("Vary: Accept-Encoding");
-
-            // Never send an etag with a 404.
-            if ($row["uri"] !== "~notfound") {
-                header("ETag: " . $row["etag"]);
-            }
-        }
-
-        // Client's cache was validated. 
-        if (is_null($row["data"])) {
-            // Since we never send etags with 404s, we will never accidentally
-            // send a 304 instead of a 404.
-            http_response_code(304);
-        }
-        // Serve the file.
-        else {
-            http_response_code($row["uri"] === "~notfound" ? 404 : 200);
-
-            // Assert that `$row["typeResource"] === "")` implies
-            // `$row["length"] === 0`.
-            assert(!($row["typeResource"] === "") | $row["length"] === 0);
-            
-            header("Content-Type: " . $row["typeResource"]);
-
-            if ($row["encoding"] !== "") {
-                header("Content-Encoding: " . $row["encoding"]);
-            }
-
-            header("Content-Length: " . $row["length"]);
-
-            switch ($row["locationData"]) {
-                case "DATABASE":
-                    echo $row["data"];
-                    break;
-                
-                case "FILESYSTEM":
-                    readfile($row["data"]);
-                    break;
-                
-                default:
-                    throw new RuntimeException("Unknown resource location: " . $row["locationData"]);
-            }
-        }
-
-        break;
-
-    case "REDIRECT":
-        switch ($row["typeRedirect"]) {
-            case "TEMPORARY":
-                http_response_code(302);
-                break;
-            
-            case "PERMANENT":
-                http_response_code(301);
-                break;
-            
-            default:
-                throw new RuntimeException("Unknown redirect duration: " . $row["typeRedirect"]);
-        }
-
-        header("Location: " . $row["locationRedirect"]);
-
-        break;
-    
-    case "DELETION":
-        http_response_code(410);
-        break;
-
-    default:
-        throw new RuntimeException("Unknown URI action: " . $row["action"]);
-}
-
 $database->close();
\ No newline at end of file
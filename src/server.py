@@ -0,0 +1,271 @@
+import base64
+import http.server
+import os
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+## The address to serve the site on.
+ADDRESS = ("localhost", 80)
+
+## The directory of the live site.
+PATH_SITE = "www"
+
+## The credentials required to access the site. Just like in `server.php`,
+## this is **NOT SECURE** and only meant to keep people from wandering in.
+CREDENTIALS = "username:password"
+
+## The biggest encodings stored in the database to keep in memory. Anything
+## bigger is read from the database whenever it is requested.
+LENGTH_PRELOAD = 1000000
+
+## How often to check whether the site has been rebuilt, in seconds.
+INTERVAL_RELOAD = 1
+
+## Returns something that changes whenever the site at the given directory is
+## rebuilt.
+def version_site(path):
+    try:
+        path_real = os.path.realpath(path)
+        stat = os.stat(path_real + "/database.db")
+    except FileNotFoundError:
+        return None
+
+    return (path_real, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+## A built site, loaded from its database. The responses the builder worked out
+## ahead of time are all kept in memory, along with all but the biggest
+## encodings, so that serving a request doesn't have to touch the database.
+class Site:
+    def __init__(self, path):
+        self.version = version_site(path)
+        self.path = os.path.realpath(path)
+        self.negotiations = {}
+
+        database = self.connect()
+
+        for uri, dictionary, status, headers, headers_content, etag, encoding, location, data \
+        in database.execute('''
+            SELECT
+                negotiations.uri,
+                dictionary,
+                status,
+                headers,
+                headers_content,
+                etag,
+                negotiations.encoding,
+                location,
+                CASE
+                    WHEN location = "FILESYSTEM" OR length <= ? THEN data
+                    ELSE NULL
+                END
+            FROM
+                negotiations
+                LEFT JOIN encodings
+                    ON negotiations.uri = encodings.uri
+                    AND negotiations.encoding = encodings.encoding
+            ORDER BY
+                negotiations.uri,
+                rank
+        ''', (LENGTH_PRELOAD,)):
+            self.negotiations.setdefault(uri, []).append({
+                "dictionary": dictionary,
+                "status": status,
+                "headers": split_headers(headers),
+                "headers_content": split_headers(headers_content),
+                "etag": etag,
+                "encoding": encoding,
+                "location": location,
+                "data": data,
+            })
+
+        database.close()
+
+    ## Opens the site's database.
+    def connect(self):
+        return sqlite3.connect(
+            "file:" + self.path + "/database.db?mode=ro",
+            uri=True,
+            check_same_thread=False
+        )
+
+    ## Returns the data of the given encoding of the given URI that wasn't
+    ## preloaded.
+    def data(self, uri, encoding):
+        database = self.connect()
+
+        (data,) = database.execute('''
+            SELECT data FROM encodings WHERE uri = ? AND encoding = ?
+        ''', (uri, encoding)).fetchone()
+
+        database.close()
+
+        return data
+
+## Splits the given precomputed headers into their names and values.
+def split_headers(headers):
+    if headers is None or headers == "":
+        return []
+
+    return [tuple(header.split(": ", 1)) for header in headers.split("\n")]
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # The headers and body go out in separate writes, which Nagle's algorithm
+    # would otherwise hold back until the client's delayed acknowledgement.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.serve(True)
+
+    def do_HEAD(self):
+        self.serve(False)
+
+    def do_POST(self):
+        self.serve(True)
+
+    ## Serves the requested URI, along with its body if asked to.
+    def serve(self, body):
+        # Pin the site for the whole request, in case it's reloaded meanwhile.
+        site = self.server.site
+
+        if self.headers.get("Authorization") \
+        != "Basic " + base64.b64encode(CREDENTIALS.encode("UTF-8")).decode("UTF-8"):
+            self.send_response(401)
+            self.send_header("WWW-Authenticate", "basic")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+            return
+
+        time_start = time.perf_counter()
+
+        # TODO handle GET arguments?
+        uri = self.path.split("?", 1)[0].split("#", 1)[0]
+
+        # Get the request etag.
+        etags = {etag.strip() for etag in self.headers.get("If-None-Match", "").split(",")}
+        etags.discard("")
+        etag = etags.pop() if len(etags) == 1 else ""
+
+        # Get the request encoding. Completely ignore the client's quality
+        # desires and impose our own.
+        encodings = {""}
+        for header_encoding in self.headers.get("Accept-Encoding", "").lower().replace(" ", "").split(","):
+            encodings.add(header_encoding.split(";q=", 1)[0])
+
+        # Clients can only decode `dcz` if they hold the dictionary it was
+        # encoded with.
+        dictionary = self.headers.get("Available-Dictionary", "").strip()
+
+        negotiations = site.negotiations.get(uri)
+        if negotiations is None:
+            uri = "~notfound"
+            negotiations = site.negotiations[uri]
+
+        # The smallest encoding the client accepts comes first.
+        for negotiation in negotiations:
+            if negotiation["encoding"] is None \
+            or negotiation["encoding"] in encodings \
+            and negotiation["dictionary"] in (None, dictionary):
+                break
+
+        duration = time.perf_counter() - time_start
+
+        # Not a resource; there's nothing more to it than the status and
+        # headers.
+        if negotiation["encoding"] is None:
+            self.send_negotiation(negotiation["status"], negotiation["headers"], duration)
+
+        # Client's cache was validated.
+        elif negotiation["etag"] == etag:
+            # Since we never send etags with 404s, we will never accidentally
+            # send a 304 instead of a 404.
+            self.send_negotiation(304, negotiation["headers"], duration)
+
+        # Serve the file.
+        else:
+            self.send_negotiation(
+                negotiation["status"],
+                negotiation["headers"] + negotiation["headers_content"],
+                duration
+            )
+
+            if not body:
+                return
+
+            data = negotiation["data"]
+
+            match negotiation["location"]:
+                case "DATABASE":
+                    if data is None:
+                        data = site.data(uri, negotiation["encoding"])
+
+                    self.wfile.write(data)
+
+                case "FILESYSTEM":
+                    with open(site.path + "/" + data, "rb") as file:
+                        self.connection.sendfile(file)
+
+                case _:
+                    raise RuntimeError("Unknown resource location: " + negotiation["location"])
+
+    ## Sends the given status along with the given headers, and how long the
+    ## given duration in seconds of looking them up took.
+    def send_negotiation(self, status, headers, duration):
+        self.send_response(status)
+        self.send_header("Server-Timing", "query;dur=" + format(duration * 1000, ".3f"))
+
+        for name, value in headers:
+            self.send_header(name, value)
+
+        # Everything without a body of its own still needs to say so to keep
+        # the connection alive.
+        if status != 304 and not any(name == "Content-Length" for name, _ in headers):
+            self.send_header("Content-Length", "0")
+
+        self.end_headers()
+
+## Watches the site for rebuilds, swapping in the new site whenever it is.
+def watch(server):
+    while True:
+        time.sleep(INTERVAL_RELOAD)
+
+        version = version_site(PATH_SITE)
+        if version is None or version == server.site.version:
+            continue
+
+        try:
+            server.site = Site(PATH_SITE)
+
+            print("\x1B[102;30m Reloaded site \x1B[0m")
+        except Exception as exception:
+            for line in traceback.format_exception(exception):
+                print("\x1B[91m" + line + "\x1B[0m", end="")
+
+def main():
+    if not os.path.exists(PATH_SITE + "/database.db"):
+        print("\x1B[41;97m No site built \x1B[0m")
+
+        sys.exit(1)
+
+    server = http.server.ThreadingHTTPServer(ADDRESS, Handler)
+    server.daemon_threads = True
+    server.site = Site(PATH_SITE)
+
+    threading.Thread(target=watch, args=(server,), daemon=True).start()
+
+    print("\x1B[102;30m Serving on http://" + ADDRESS[0] + ":" + str(ADDRESS[1]) + " \x1B[0m")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import builder
+import json
+import math
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+
+## The sizes of the encodings to measure reading, in bytes.
+SIZES = [2 ** exponent for exponent in range(10, 24)]
+
+## The number of times to read each encoding. The median read is taken.
+COUNT_READS = 50
+
+## Returns the median duration of calling the given function, in seconds.
+def measure(function):
+    # Warm up the caches, as they would be on a busy server.
+    function()
+
+    durations = []
+
+    for _ in range(COUNT_READS):
+        time_start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - time_start)
+
+    return statistics.median(durations)
+
+## Measures how long reading encodings of every size takes from the database and
+## from the filesystem, and picks the size from which on the filesystem is faster
+## as the threshold for the builder.
+def main():
+    directory = tempfile.TemporaryDirectory(dir=".")
+
+    path_database = directory.name + "/database.db"
+
+    database = sqlite3.connect(path_database)
+    database.executescript('''
+        CREATE TABLE encodings (
+            uri TEXT,
+            data BLOB,
+            PRIMARY KEY (uri)
+        );
+    ''')
+
+    for size in SIZES:
+        data = os.urandom(size)
+
+        database.execute('''
+            INSERT INTO encodings (uri, data) VALUES (?, ?)
+        ''', (str(size), data))
+
+        file = open(directory.name + "/" + str(size), "wb")
+        file.write(data)
+        file.close()
+
+    database.commit()
+    database.close()
+
+    # The server has the database open anyway to look up the negotiation, so
+    # only the read itself counts against it.
+    database = sqlite3.connect("file:" + path_database + "?mode=ro", uri=True)
+
+    ## Reads the encoding of the given size from the database.
+    def read_database(size):
+        database.execute('''
+            SELECT data FROM encodings WHERE uri = ?
+        ''', (str(size),)).fetchone()
+
+    ## Reads the encoding of the given size from the filesystem.
+    def read_filesystem(size):
+        file = open(directory.name + "/" + str(size), "rb")
+        file.read()
+        file.close()
+
+    measurements = []
+
+    for size in SIZES:
+        duration_database = measure(lambda: read_database(size))
+        duration_filesystem = measure(lambda: read_filesystem(size))
+
+        measurements.append({
+            "size": size,
+            "database": duration_database,
+            "filesystem": duration_filesystem,
+        })
+
+        print(
+            str(size).rjust(10) + " B"
+            + format(duration_database * 1000000, ".1f").rjust(12) + " µs database"
+            + format(duration_filesystem * 1000000, ".1f").rjust(12) + " µs filesystem"
+        )
+
+    database.close()
+    directory.cleanup()
+
+    # The threshold lies between the biggest size still read faster from the
+    # database and the smallest read faster from the filesystem.
+    threshold = SIZES[-1]
+
+    for index, measurement in enumerate(measurements):
+        if measurement["filesystem"] < measurement["database"]:
+            if index == 0:
+                threshold = SIZES[0]
+            else:
+                threshold = round(math.sqrt(SIZES[index - 1] * SIZES[index]))
+
+            break
+
+    if not os.path.exists("msssg"):
+        os.mkdir("msssg")
+
+    json.dump(
+        {
+            "threshold": threshold,
+            "measurements": measurements,
+        },
+        open(builder.PATH_STORAGE, "w"),
+        indent=4
+    )
+
+    print("\x1B[102;30m Threshold: " + str(threshold) + " B \x1B[0m")
+
+if __name__ == "__main__":
+    main()
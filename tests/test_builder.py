@@ -0,0 +1,582 @@
+import io
+import json
+import numpy
+import os
+import PIL.Image
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+## The directory of the builder.
+PATH_SOURCE = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + "/src"
+
+sys.path.insert(0, PATH_SOURCE)
+
+import builder
+
+try:
+    import skimage.metrics
+except ImportError:
+    skimage = None
+
+## How long a test waits on the scheduler before calling it a deadlock, in
+## seconds.
+TIMEOUT_SCHEDULER = 10
+
+## Returns a document with the given body, in the form the builder expects its
+## sources in.
+def document(body):
+    return '''<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:msssg="http://localhost/msssg" lang="en" xml:lang="en">
+    <head>
+        <meta charset="UTF-8" />
+        <title>Test</title>
+    </head>
+    <body>
+''' + body + '''
+    </body>
+</html>'''
+
+## Returns the body of a document that uses the stylesheet and picture at the
+## given paths.
+def body_assets(path_stylesheet, path_picture):
+    return '''
+        <link rel="stylesheet" href="''' + path_stylesheet + '''" msssg:asset="href" msssg:type="text/css;charset=UTF-8" />
+        <picture msssg:type="GRAPHIC" msssg:quality="LOSSLESS">
+            <img src="''' + path_picture + '''" srcset="''' + path_picture + '''" sizes="100vw" />
+        </picture>'''
+
+## Writes the given text to the file at the given path.
+def write(path, text):
+    file = open(path, "w")
+    file.write(text)
+    file.close()
+
+class TestBuilder(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+        os.makedirs(self.path + "/src/www/sub")
+        os.makedirs(self.path + "/msssg")
+
+        shutil.copy(PATH_SOURCE + "/server.php", self.path + "/src/server.php")
+
+        # Store every encoding as a file, so that those get shared too.
+        json.dump({"threshold": 0}, open(self.path + "/msssg/storage.json", "w"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    ## Builds the site with the given arguments, failing the test if the build
+    ## fails.
+    def build(self, *arguments):
+        process = subprocess.run(
+            [sys.executable, PATH_SOURCE + "/builder.py", *arguments],
+            cwd=self.path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT
+        )
+
+        self.assertEqual(process.returncode, 0, process.stdout.decode("UTF-8", "replace"))
+
+    ## Returns the given URI as served, without any encoding, failing the test
+    ## if it is missing.
+    def served(self, uri):
+        database = sqlite3.connect(self.path + "/www/database.db")
+
+        try:
+            self.assertIsNotNone(
+                database.execute("SELECT uri FROM resources WHERE uri = ?", (uri,)).fetchone(),
+                "Missing resource: " + uri
+            )
+            self.assertIsNotNone(
+                database.execute(
+                    "SELECT uri FROM negotiations WHERE uri = ? AND encoding = ''",
+                    (uri,)
+                ).fetchone(),
+                "Missing negotiation: " + uri
+            )
+
+            content = None
+
+            for encoding, location, data in database.execute(
+                "SELECT encoding, location, data FROM encodings WHERE uri = ?",
+                (uri,)
+            ):
+                if location == "FILESYSTEM":
+                    self.assertTrue(
+                        os.path.exists(self.path + "/www/" + data),
+                        "Missing file of " + uri + ": " + data
+                    )
+                    data = open(self.path + "/www/" + data, "rb").read()
+
+                if encoding == "":
+                    content = data
+
+            self.assertIsNotNone(content, "Missing encoding: " + uri)
+
+            return content
+        finally:
+            database.close()
+
+    ## Identical assets at different paths share their URI. Dropping one of
+    ## them on a rebuild mustn't take the other down with it.
+    def test_shared_asset_dropped(self):
+        write(self.path + "/src/www/style.css", "body { margin: 0; }\n")
+        shutil.copy(self.path + "/src/www/style.css", self.path + "/src/www/sub/style.css")
+
+        PIL.Image.new("RGB", (40, 30), (200, 100, 50)).save(self.path + "/src/www/logo.png")
+        shutil.copy(self.path + "/src/www/logo.png", self.path + "/src/www/sub/logo.png")
+
+        write(self.path + "/src/www/index.html", document(body_assets("style.css", "logo.png")))
+        write(self.path + "/src/www/two.html", document(body_assets("sub/style.css", "sub/logo.png")))
+        write(self.path + "/src/www/notfound.html", document("<p>Not found.</p>"))
+
+        json.dump({
+            "/": {
+                "action": "RESOURCE",
+                "path": "src/www/index.html",
+                "type": "application/msssg+xml;charset=UTF-8",
+                "cache": "NONE",
+            },
+            "/two": {
+                "action": "RESOURCE",
+                "path": "src/www/two.html",
+                "type": "application/msssg+xml;charset=UTF-8",
+                "cache": "NONE",
+            },
+            "~notfound": {
+                "action": "RESOURCE",
+                "path": "src/www/notfound.html",
+                "type": "application/msssg+xml;charset=UTF-8",
+                "cache": "SHORT",
+            },
+        }, open(self.path + "/src/links.json", "w"))
+
+        self.build()
+
+        uris = set(re.findall(r"/a/[\w-]+", self.served("/").decode("UTF-8")))
+        uris_two = set(re.findall(r"/a/[\w-]+", self.served("/two").decode("UTF-8")))
+
+        self.assertGreater(len(uris), 1)
+        self.assertEqual(uris, uris_two)
+
+        # The second page no longer uses its copies.
+        write(self.path + "/src/www/two.html", document("<p>Nothing.</p>"))
+
+        self.build()
+
+        for uri in uris:
+            self.served(uri)
+
+        self.assertEqual(set(re.findall(r"/a/[\w-]+", self.served("/").decode("UTF-8"))), uris)
+
+    ## Rebuilds that leave assets as they are still report what minifying saved
+    ## on them.
+    def test_minify_report_kept(self):
+        write(self.path + "/src/www/style.css", "body  {  margin:  0;  }\n\n")
+        write(self.path + "/src/www/index.html", document(body_assets("style.css", "logo.png")))
+        write(self.path + "/src/www/two.html", document("<p>Two.</p>"))
+        write(self.path + "/src/www/notfound.html", document("<p>Not found.</p>"))
+
+        PIL.Image.new("RGB", (40, 30), (200, 100, 50)).save(self.path + "/src/www/logo.png")
+
+        json.dump({
+            "/": {
+                "action": "RESOURCE",
+                "path": "src/www/index.html",
+                "type": "application/msssg+xml;charset=UTF-8",
+                "cache": "NONE",
+            },
+            "/two": {
+                "action": "RESOURCE",
+                "path": "src/www/two.html",
+                "type": "application/msssg+xml;charset=UTF-8",
+                "cache": "NONE",
+            },
+            "~notfound": {
+                "action": "RESOURCE",
+                "path": "src/www/notfound.html",
+                "type": "application/msssg+xml;charset=UTF-8",
+                "cache": "SHORT",
+            },
+        }, open(self.path + "/src/links.json", "w"))
+
+        self.build()
+
+        report = json.load(open(self.path + "/msssg/minify.json"))
+
+        self.assertGreater(report["before"], report["after"])
+
+        # Nothing changed.
+        self.build()
+
+        self.assertEqual(json.load(open(self.path + "/msssg/minify.json")), report)
+
+        # Only the second page is rebuilt.
+        write(self.path + "/src/www/two.html", document("<p>Two again.</p>"))
+
+        self.build()
+
+        report_patched = json.load(open(self.path + "/msssg/minify.json"))
+
+        self.assertEqual(
+            {entry["asset"] for entry in report_patched["assets"]},
+            {entry["asset"] for entry in report["assets"]}
+        )
+        self.assertEqual(
+            [entry for entry in report_patched["assets"] if entry["uri"] != "/two"],
+            [entry for entry in report["assets"] if entry["uri"] != "/two"]
+        )
+
+    ## A rebuild only rebuilds the links whose files changed, and keeps the
+    ## rest of the previous build as it was.
+    def test_patch(self):
+        write(self.path + "/src/www/style.css", "body { margin: 0; }\n")
+        write(self.path + "/src/www/index.html", document(body_assets("style.css", "logo.png")))
+        write(self.path + "/src/www/two.html", document("<p>Two.</p>"))
+        write(self.path + "/src/www/three.html", document("<p>Three.</p>"))
+        write(self.path + "/src/www/notfound.html", document("<p>Not found.</p>"))
+
+        PIL.Image.new("RGB", (40, 30), (200, 100, 50)).save(self.path + "/src/www/logo.png")
+
+        links = {
+            "/": {
+                "action": "RESOURCE",
+                "path": "src/www/index.html",
+                "type": "application/msssg+xml;charset=UTF-8",
+                "cache": "NONE",
+            },
+            "/two": {
+                "action": "RESOURCE",
+                "path": "src/www/two.html",
+                "type": "application/msssg+xml;charset=UTF-8",
+                "cache": "NONE",
+            },
+            "~notfound": {
+                "action": "RESOURCE",
+                "path": "src/www/notfound.html",
+                "type": "application/msssg+xml;charset=UTF-8",
+                "cache": "SHORT",
+            },
+        }
+
+        json.dump(links, open(self.path + "/src/links.json", "w"))
+
+        self.build()
+
+        index = self.served("/")
+
+        # One page changes and another one is added.
+        write(self.path + "/src/www/two.html", document("<p>Two again.</p>"))
+
+        links["/three"] = dict(links["/two"], path="src/www/three.html")
+        json.dump(links, open(self.path + "/src/links.json", "w"))
+
+        self.build("--profile")
+
+        trace = json.load(open(self.path + "/" + builder.PATH_TRACE_PROFILE))
+        ids = {
+            event["args"]["asset"]
+            for event in trace["traceEvents"]
+            if "asset" in event.get("args", {})
+        }
+
+        self.assertIn("src/www/two.html", ids)
+        self.assertIn("src/www/three.html", ids)
+
+        for id in ids:
+            for name in ["index.html", "style.css", "logo.png"]:
+                self.assertNotIn(name, id)
+
+        self.assertEqual(self.served("/"), index)
+        self.assertIn(b"Two again.", self.served("/two"))
+        self.assertIn(b"Three.", self.served("/three"))
+
+        for uri in re.findall(r"/a/[\w-]+", index.decode("UTF-8")):
+            self.served(uri)
+
+class TestScheduler(unittest.TestCase):
+    ## Runs the given function on a thread of its own, failing the test if it
+    ## doesn't return in time. Returns what the function returned.
+    def finishes(self, function):
+        results = []
+
+        thread = threading.Thread(target=lambda: results.append(function()), daemon=True)
+        thread.start()
+        thread.join(TIMEOUT_SCHEDULER)
+
+        self.assertFalse(thread.is_alive(), "Deadlocked")
+
+        return results[0]
+
+    ## Without threads of its own, the scheduler only gets a queued n-task
+    ## done by running it on the thread waiting for it.
+    def test_wait_runs_queued_inline(self):
+        scheduler = builder.Scheduler(None, 0, 0)
+
+        task = scheduler.ntask(threading.get_ident, ())
+
+        self.assertEqual(task.state, "QUEUED")
+
+        ident, ident_waiting = self.finishes(lambda: (task.wait(), threading.get_ident()))
+
+        self.assertEqual(ident, ident_waiting)
+        self.assertEqual(task.state, "DONE")
+
+        scheduler.close()
+
+    ## Waiting on a task whose dependencies are still queued runs them first.
+    def test_wait_runs_dependencies_inline(self):
+        scheduler = builder.Scheduler(None, 0, 0)
+
+        order = []
+
+        first = scheduler.ntask(order.append, ("first",))
+        second = scheduler.ntask(order.append, ("second",), dependencies=[first])
+
+        self.assertEqual(second.state, "BLOCKED")
+
+        self.finishes(second.wait)
+
+        self.assertEqual(order, ["first", "second"])
+
+        scheduler.close()
+
+    ## Tasks that wait on tasks of their own, deeper than there are threads,
+    ## still get done.
+    def test_nested_waits(self):
+        scheduler = builder.Scheduler(None, 0, 2)
+
+        ## Returns the given depth, after waiting on a task a level deeper.
+        def nest(depth):
+            if depth < 20:
+                self.assertEqual(scheduler.ntask(nest, (depth + 1,)).wait(), depth + 1)
+
+            return depth
+
+        tasks = [scheduler.ntask(nest, (0,)) for _ in range(8)]
+
+        self.assertEqual(self.finishes(lambda: [task.wait() for task in tasks]), [0] * 8)
+
+        scheduler.close()
+
+    ## A thread waiting on a task another thread runs mustn't pick up other
+    ## work meanwhile, which could wait on a task further down its own stack.
+    def test_wait_runs_nothing_else(self):
+        scheduler = builder.Scheduler(None, 0, 0)
+
+        started = threading.Event()
+        released = threading.Event()
+
+        ## Blocks until released.
+        def block():
+            started.set()
+            released.wait()
+
+        blocking = scheduler.ntask(block, ())
+        threading.Thread(target=blocking.wait, daemon=True).start()
+        started.wait()
+
+        shared = scheduler.ntask(blocking.wait, ())
+        waiting = scheduler.ntask(shared.wait, ())
+
+        thread = threading.Thread(target=shared.wait, daemon=True)
+        thread.start()
+
+        # Let the shared task get to waiting on the blocking one first.
+        thread.join(0.5)
+        released.set()
+
+        self.finishes(lambda: (thread.join(), waiting.wait()))
+
+        scheduler.close()
+
+    ## A failing task raises its exception in whoever waits on it.
+    def test_wait_raises(self):
+        scheduler = builder.Scheduler(None, 0, 1)
+
+        task = scheduler.ntask(int, ("not a number",))
+
+        with self.assertRaises(ValueError):
+            task.wait()
+
+        scheduler.close()
+
+class TestStylesheet(unittest.TestCase):
+    ## Only the style rules that match are kept, and grouping at-rules are
+    ## pruned the same way.
+    def test_prune(self):
+        stylesheet = '''@charset "UTF-8";
+@import url("print.css") print;
+/* Braces in comments { don't count. */
+.used { color: red; }
+.unused { color: blue; }
+@media (min-width: 40em) {
+    .used { margin: 0; }
+    .unused { margin: 1em; }
+}
+@media print { .unused { display: none; } }
+@layer base { .unused { color: green; } }
+@font-face { font-family: "Font"; src: url("font.woff2"); }
+a[title="}"] { color: black; }
+'''
+
+        pruned = builder.prune_stylesheet(stylesheet, lambda selector: "unused" not in selector)
+
+        self.assertEqual(pruned.split("\n"), [
+            '@import url("print.css") print;',
+            ".used{ color: red; }",
+            "@media (min-width: 40em){.used{ margin: 0; }}",
+            "@layer base{}",
+            '@font-face{ font-family: "Font"; src: url("font.woff2"); }',
+            'a[title="}"]{ color: black; }',
+        ])
+
+    ## Pruning with every rule matching changes nothing but the formatting.
+    def test_prune_all_match(self):
+        stylesheet = ".a { color: red; }\n@media print { .b { color: blue; } }\n"
+
+        self.assertEqual(
+            builder.prune_stylesheet(stylesheet, lambda selector: True),
+            ".a{ color: red; }\n@media print{.b{ color: blue; }}"
+        )
+
+class TestOptimizePng(unittest.TestCase):
+    ## Returns the given pixels as a PNG of the given mode.
+    def png(self, pixels, mode):
+        output = io.BytesIO()
+        PIL.Image.fromarray(pixels).convert(mode).save(output, "PNG")
+
+        return output.getvalue()
+
+    ## Asserts that the given PNG optimizes to one at most as big with the
+    ## exact same pixels.
+    def assertLossless(self, data):
+        data_optimized = builder.optimize_png(data)
+
+        self.assertLessEqual(len(data_optimized), len(data))
+
+        with PIL.Image.open(io.BytesIO(data)) as image:
+            pixels = numpy.asarray(image.convert("RGBA"))
+
+        with PIL.Image.open(io.BytesIO(data_optimized)) as image:
+            pixels_optimized = numpy.asarray(image.convert("RGBA"))
+
+        self.assertTrue(numpy.array_equal(pixels, pixels_optimized))
+
+    def test_colors(self):
+        generator = numpy.random.default_rng(0)
+
+        pixels = generator.integers(0, 256, (37, 53, 4), dtype=numpy.uint8)
+
+        self.assertLossless(self.png(pixels[..., :3], "RGB"))
+        self.assertLossless(self.png(pixels, "RGBA"))
+
+        # An alpha channel that is opaque throughout.
+        pixels[..., 3] = 255
+        self.assertLossless(self.png(pixels, "RGBA"))
+
+    def test_grays(self):
+        generator = numpy.random.default_rng(1)
+
+        grays = generator.integers(0, 256, (37, 53), dtype=numpy.uint8)
+
+        self.assertLossless(self.png(grays, "L"))
+        self.assertLossless(self.png(numpy.stack([grays] * 3, axis=-1), "RGB"))
+        self.assertLossless(self.png(numpy.stack([grays, grays[::-1]], axis=-1), "LA"))
+
+    ## Few enough colors go in a palette, at every depth.
+    def test_palettes(self):
+        generator = numpy.random.default_rng(2)
+
+        for count in [2, 3, 16, 200]:
+            palette = generator.integers(0, 256, (count, 4), dtype=numpy.uint8)
+            palette[: count // 2, 3] = 255
+
+            pixels = palette[generator.integers(0, count, (37, 53))]
+
+            self.assertLossless(self.png(pixels, "RGBA"))
+            self.assertLossless(self.png(pixels[..., :3], "RGB"))
+
+class TestQuality(unittest.TestCase):
+    def setUp(self):
+        generator = numpy.random.default_rng(3)
+
+        # Smooth shapes with some grain, like a photo.
+        coarse = generator.integers(0, 256, (6, 6, 3), dtype=numpy.uint8)
+        image = PIL.Image.fromarray(coarse).resize((96, 64), PIL.Image.BICUBIC)
+
+        pixels = numpy.asarray(image).astype(numpy.int16)
+        pixels += generator.integers(-10, 11, pixels.shape, dtype=numpy.int16)
+
+        self.pixels = numpy.clip(pixels, 0, 255).astype(numpy.uint8)
+        self.noisy = numpy.clip(
+            pixels + generator.integers(-40, 41, pixels.shape, dtype=numpy.int16),
+            0,
+            255
+        ).astype(numpy.uint8)
+
+    def test_ssim_identical(self):
+        self.assertAlmostEqual(builder.ssim(self.pixels, self.pixels), 1)
+        self.assertAlmostEqual(builder.ssim(self.pixels[..., 0], self.pixels[..., 0], False), 1)
+
+    @unittest.skipIf(skimage is None, "scikit-image is not installed")
+    def test_ssim_scikit_image(self):
+        self.assertAlmostEqual(
+            builder.ssim(self.pixels, self.noisy),
+            skimage.metrics.structural_similarity(
+                self.pixels,
+                self.noisy,
+                channel_axis=-1,
+                data_range=255
+            )
+        )
+        self.assertAlmostEqual(
+            builder.ssim(self.pixels[..., 0], self.noisy[..., 0], False),
+            skimage.metrics.structural_similarity(
+                self.pixels[..., 0],
+                self.noisy[..., 0],
+                data_range=255
+            )
+        )
+
+    ## Leading axes are batched over.
+    def test_ssim_batched(self):
+        batched = builder.ssim(
+            numpy.stack([self.pixels, self.pixels]),
+            numpy.stack([self.pixels, self.noisy])
+        )
+
+        self.assertAlmostEqual(batched[0], 1)
+        self.assertAlmostEqual(batched[1], builder.ssim(self.pixels, self.noisy))
+
+    ## The setting found is the lowest that meets the target.
+    def test_search_quality(self):
+        image = PIL.Image.fromarray(self.pixels)
+
+        # Chroma subsampling keeps JPEGs of this image from getting much higher.
+        target = 0.9
+
+        ## Returns the SSIM of the image encoded with the given setting.
+        def ssim_setting(value_quality):
+            data = builder.encode_image(image, "image/jpeg", None, value_quality)
+
+            with PIL.Image.open(io.BytesIO(data)) as render:
+                return builder.ssim(self.pixels, numpy.asarray(render.convert("RGB")))
+
+        data, value_quality = builder.search_quality(image, "image/jpeg", target)
+
+        self.assertEqual(data, builder.encode_image(image, "image/jpeg", None, value_quality))
+        self.assertGreaterEqual(ssim_setting(value_quality), target)
+        self.assertGreater(value_quality, builder.RANGES_QUALITY_GRAPHIC["image/jpeg"][0])
+        self.assertLess(ssim_setting(value_quality - 1), target)
+
+if __name__ == "__main__":
+    unittest.main()